@@ -0,0 +1,110 @@
+import hashlib
+import pickle
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import *
+
+import black
+
+# digest of the source, line length, file mode, black version
+Key = Tuple[bytes, int, int, str]
+
+# rough per entry cost of the key, the entry and the dict slot
+ENTRY_OVERHEAD = 256
+
+
+@dataclass
+class Entry:
+    # None if the source is already well formatted, or only `digest` is known
+    formatted: Optional[bytes]
+    # False if the result was produced with --fast
+    verified: bool
+    # of the formatted source, where a worker only sent back a compact result
+    digest: Optional[bytes] = None
+    # the hunks of its diff, if the compact result had them
+    diff: Optional[str] = None
+
+    @property
+    def unchanged(self) -> bool:
+        return self.formatted is None and self.digest is None
+
+    @property
+    def size(self) -> int:
+        return ENTRY_OVERHEAD + len(self.formatted or b"") + len(self.diff or "")
+
+
+def digest(contents: bytes) -> bytes:
+    return hashlib.sha256(contents).digest()
+
+
+def make_key(digest: bytes, line_length: int, mode: black.FileMode) -> Key:
+    return (digest, line_length, mode.value, black.__version__)
+
+
+def pair_key(key: Key, formatted_digest: bytes) -> Key:
+    """The key of the source with `formatted_digest` being the result of
+    formatting the source of `key`."""
+    return (digest(key[0] + formatted_digest), *key[1:])
+
+
+class FormatCache:
+    """Content addressed LRU cache of formatting results, capped at `max_size`
+    bytes."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.dirty = False
+        self.entries: "OrderedDict[Key, Entry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Key, *, fast: bool) -> Optional[Entry]:
+        entry = self.entries.get(key)
+        if entry is None or not (fast or entry.verified):
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Key, entry: Entry) -> None:
+        self.discard(key)
+        if entry.size > self.max_size:
+            return
+        self.entries[key] = entry
+        self.size += entry.size
+        self.dirty = True
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def discard(self, key: Key) -> None:
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+            self.dirty = True
+
+    def snapshot(self) -> Dict[Key, Entry]:
+        self.dirty = False
+        return dict(self.entries)
+
+    def load(self, path: Path) -> None:
+        try:
+            with path.open("rb") as fobj:
+                entries: Dict[Key, Entry] = pickle.load(fobj)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        for key, entry in entries.items():
+            self.put(key, entry)
+        self.dirty = False
+
+
+def dump(entries: Dict[Key, Entry], path: Path) -> None:
+    tmp = path.with_suffix(".tmp")
+    try:
+        with tmp.open("wb") as fobj:
+            pickle.dump(entries, fobj, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(path)
+    except OSError:
+        pass
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+import socket
+import sys
+import time
+from importlib import import_module
+from pathlib import Path
+from types import ModuleType
+from typing import *
+
+import click
+
+from . import demon
+from . import ipcserver
+from . import protocol
+from . import registry
+from . import store
+from .config import (
+    get_address,
+    get_max_servers,
+    get_pid_file,
+    get_pipe_name,
+    get_server_id,
+    get_socket_path,
+    get_store_file,
+)
+
+# Only what is needed to bind the socket is imported up front, black and the
+# rest of the server are imported once clients can already connect.
+
+
+if sys.platform == "win32":
+
+    from asyncio.windows_events import CONNECT_PIPE_INIT_DELAY, CONNECT_PIPE_MAX_DELAY
+    import _overlapped
+    import _winapi
+
+    def wait_connectable(timeout: Union[int, float]) -> None:
+        end = time.monotonic() + timeout
+        delay = CONNECT_PIPE_INIT_DELAY
+        address = get_pipe_name()
+        while time.monotonic() < end:
+            try:
+                handle = _overlapped.ConnectPipe(address)
+                _winapi.CloseHandle(handle)
+                return
+            except OSError as exc:
+                if exc.winerror != _overlapped.ERROR_PIPE_BUSY:
+                    raise
+
+            # ConnectPipe() failed with ERROR_PIPE_BUSY: retry later
+            delay = min(delay * 2, CONNECT_PIPE_MAX_DELAY)
+            time.sleep(delay)
+        raise Exception("Server did not start")
+
+
+else:
+
+    def wait_connectable(timeout: Union[int, float]) -> None:
+        end = time.monotonic() + timeout
+        delay = 0.001
+        while end > time.monotonic():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(get_socket_path())
+                return
+            except OSError:
+                pass
+            finally:
+                sock.close()
+            delay = min(delay * 2, 0.1)
+            time.sleep(delay)
+        raise Exception("Server did not start")
+
+
+async def serve() -> None:
+    server_id = get_server_id()
+    server: Optional[ModuleType] = None
+
+    async def connected(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        registry.touch(server_id)
+        await server.connected(reader, writer)
+
+    async def prepare() -> None:
+        nonlocal server
+        server = import_module("blackfast.server")
+        registry.register(
+            server_id,
+            {
+                "pid_file": str(get_pid_file()),
+                "address": get_address(),
+                "black": server.black.__version__,
+                "python": sys.executable,
+            },
+        )
+        await server.start()
+
+    try:
+        await ipcserver.run(
+            get_socket_path(), get_pipe_name(), connected, prepare, demon.ready
+        )
+    finally:
+        registry.unregister(server_id)
+        if server is not None:
+            server.stop()
+
+
+def run():
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())
+
+
+@click.group()
+def cli() -> None:
+    # the server process cannot tell which environment it was started from
+    os.environ["BLACKFAST_SERVER_ID"] = get_server_id()
+
+
+@cli.command("start")
+def start() -> None:
+    registry.evict(get_server_id(), get_max_servers() - 1)
+    try:
+        ready = demon.spawn(get_pid_file(), run)
+    except demon.PidExists:
+        ready = None
+    if ready is None:
+        wait_connectable(10)
+    elif not demon.wait_ready(ready, 10):
+        raise Exception("Server did not start")
+
+
+@cli.command("watch", context_settings={"ignore_unknown_options": True})
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.pass_context
+def watch(ctx: click.Context, args: Tuple[str, ...]) -> None:
+    """Keep the results for the given directories warm in the server. Accepts
+    the same options as blackfast."""
+    ctx.invoke(start)
+    sys.exit(
+        protocol.request(get_address(), ["--work-dir", os.getcwd(), "--watch", *args])
+    )
+
+
+@cli.command("stats")
+@click.option("--json", "json_output", is_flag=True, help="Output JSON.")
+def stats(json_output: bool) -> None:
+    """Show what the running server did since it started."""
+    try:
+        return_code = protocol.request(
+            get_address(),
+            ["--work-dir", os.getcwd(), "--stats", "json" if json_output else "text"],
+        )
+    except OSError:
+        raise click.ClickException("The server is not running")
+    sys.exit(return_code)
+
+
+@cli.command("stop")
+@click.option(
+    "--all", "stop_all", is_flag=True, help="Stop the servers of all environments."
+)
+def stop(stop_all: bool) -> None:
+    if stop_all:
+        for server_id, _, info in registry.servers():
+            registry.stop(server_id, info)
+        return
+    try:
+        demon.kill(get_pid_file())
+    except demon.PidDoesNotExist:
+        pass
+
+
+@cli.group("cache")
+def cache_group() -> None:
+    """Share what is known to be well formatted between machines."""
+
+
+@cache_group.command("export")
+@click.argument("path", type=click.Path(dir_okay=False))
+def cache_export(path: str) -> None:
+    """Write the sources verified to be well formatted to PATH."""
+    count = store.Store(get_store_file()).export(Path(path))
+    click.echo(f"Exported {count} verified sources to {path}.")
+
+
+@cache_group.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def cache_import(path: str) -> None:
+    """Add the sources verified to be well formatted from the export at PATH.
+    Running servers pick them up right away."""
+    try:
+        count = store.Store(get_store_file()).load(Path(path))
+    except store.StoreError as exc:
+        raise click.ClickException(str(exc))
+    click.echo(f"Imported {count} verified sources from {path}.")
+
+
+@cli.command("list")
+def list_servers() -> None:
+    """List the running servers, most recently used first."""
+    for server_id, last_used, info in registry.servers():
+        current = "*" if server_id == get_server_id() else " "
+        click.echo(
+            f"{current} {server_id} black {info['black']} {info['python']} "
+            f"last used {time.ctime(last_used)}"
+        )
+
+
+if __name__ == "__main__":
+    cli()
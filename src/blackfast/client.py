@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import *
+
+from . import protocol
+from .config import get_address
+from .protocol import Frame
+
+DEFAULT_POOL_SIZE = 2
+
+
+@dataclass
+class Response:
+    exit_code: int = 0
+    stdout: bytearray = field(default_factory=bytearray)
+    stderr: bytearray = field(default_factory=bytearray)
+    # the formatted source of a request with stdin, None if it was left as is
+    formatted: Optional[bytes] = None
+    # with --stream
+    results: List[Dict[str, Any]] = field(default_factory=list)
+    summary: Optional[Dict[str, Any]] = None
+
+
+async def open_connection(
+    address: str
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if sys.platform != "win32":
+        return await asyncio.open_unix_connection(address)
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader()
+    transport, stream = await loop.create_pipe_connection(
+        lambda: asyncio.StreamReaderProtocol(reader), address
+    )
+    return reader, asyncio.StreamWriter(transport, stream, reader, loop)
+
+
+class Connection:
+    """A connection to the server, carrying any number of requests at the same
+    time. Use `open` to create one."""
+
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.next_id = 0
+        self.pending: Dict[int, Tuple[Response, "asyncio.Future[Response]"]] = {}
+        self.closed = False
+        self.reading = asyncio.ensure_future(self.read(reader))
+
+    @classmethod
+    async def open(cls, address: Optional[str] = None) -> "Connection":
+        reader, writer = await open_connection(address or get_address())
+        writer.write(protocol.hello())
+        kind, _, payload = await protocol.read_frame(reader)
+        if kind is not Frame.HELLO or payload != protocol.U32.pack(protocol.VERSION):
+            writer.close()
+            raise protocol.ProtocolError(
+                "server speaks a different protocol version, restart it with "
+                "`blackfast-server stop`"
+            )
+        return cls(reader, writer)
+
+    async def request(
+        self,
+        args: List[str],
+        stdin: Optional[bytes] = None,
+        work_dir: Optional[str] = None,
+    ) -> Response:
+        """Run black with `args` in `work_dir`, the current directory by default.
+        `stdin` is the source to format if `args` contain "-"."""
+        if self.closed:
+            raise ConnectionError("connection to the server is closed")
+        request_id = self.next_id
+        self.next_id += 1
+        response = Response()
+        done = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = response, done
+        args = ["--work-dir", work_dir or os.getcwd(), *args]
+        if stdin is not None:
+            self.writer.write(protocol.pack(Frame.STDIN, stdin, request_id))
+        self.writer.write(
+            protocol.pack(Frame.ARGS, json.dumps(args).encode("utf-8"), request_id)
+        )
+        try:
+            async with self.lock:
+                await self.writer.drain()
+        except ConnectionError:
+            # reading fails the request
+            pass
+        return await done
+
+    async def read(self, reader: asyncio.StreamReader) -> None:
+        error: Exception = ConnectionError("connection closed by the server")
+        try:
+            while True:
+                kind, request_id, payload = await protocol.read_frame(reader)
+                if kind is Frame.ERROR:
+                    error = protocol.ProtocolError(payload.decode("utf-8"))
+                    break
+                try:
+                    response, done = self.pending[request_id]
+                except KeyError:
+                    error = protocol.ProtocolError(f"unknown request {request_id}")
+                    break
+                if kind is Frame.STDOUT:
+                    response.stdout.extend(payload)
+                elif kind is Frame.STDERR:
+                    response.stderr.extend(payload)
+                elif kind is Frame.FORMATTED:
+                    response.formatted = payload
+                elif kind is Frame.RESULT:
+                    response.results.append(json.loads(payload))
+                elif kind is Frame.SUMMARY:
+                    response.summary = json.loads(payload)
+                elif kind is Frame.EXIT:
+                    (response.exit_code,) = protocol.I32.unpack(payload)
+                    del self.pending[request_id]
+                    # unless the caller gave up on it
+                    if not done.done():
+                        done.set_result(response)
+                elif kind is not Frame.UNCHANGED:
+                    error = protocol.ProtocolError(f"unexpected {kind.name} frame")
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except protocol.ProtocolError as exc:
+            error = exc
+        finally:
+            self.closed = True
+            self.writer.close()
+            for _, done in self.pending.values():
+                if not done.done():
+                    done.set_exception(error)
+            self.pending.clear()
+
+    async def close(self) -> None:
+        self.writer.close()
+        await self.reading
+
+    async def __aenter__(self) -> "Connection":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+
+class Pool:
+    """Up to `size` connections to the server listening at `address`, opened
+    when needed and kept open for later requests. Requests go to the connection
+    with the fewest requests in progress."""
+
+    def __init__(
+        self, address: Optional[str] = None, size: int = DEFAULT_POOL_SIZE
+    ) -> None:
+        self.address = address
+        self.size = size
+        self.connections: List[Connection] = []
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def connection(self) -> Connection:
+        if self.lock is None:
+            # created here, so the pool can be created outside of the event loop
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            self.connections = [conn for conn in self.connections if not conn.closed]
+            if self.connections:
+                idlest = min(self.connections, key=lambda conn: len(conn.pending))
+                if not idlest.pending or len(self.connections) >= self.size:
+                    return idlest
+            connection = await Connection.open(self.address)
+            self.connections.append(connection)
+            return connection
+
+    async def request(
+        self,
+        args: List[str],
+        stdin: Optional[bytes] = None,
+        work_dir: Optional[str] = None,
+    ) -> Response:
+        """See `Connection.request`."""
+        connection = await self.connection()
+        return await connection.request(args, stdin, work_dir)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(conn.close() for conn in self.connections))
+        self.connections = []
+
+    async def __aenter__(self) -> "Pool":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
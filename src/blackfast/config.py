@@ -0,0 +1,85 @@
+import os
+import sys
+from pathlib import Path
+
+import appdirs
+
+p = lambda b, n: str((Path(b) / n).absolute())
+
+
+def ensure(*paths: str) -> None:
+    for path in paths:
+        path = Path(path)
+        if not path.exists():
+            path.mkdir(parents=True)
+
+
+dirs = appdirs.AppDirs("blackfast")
+ensure(dirs.user_data_dir, dirs.user_log_dir, dirs.user_cache_dir)
+STDOUT_LOG = p(dirs.user_log_dir, "stdout.log")
+STDERR_LOG = p(dirs.user_log_dir, "stderr.log")
+SERVERS_DIR = p(dirs.user_data_dir, "servers")
+ensure(SERVERS_DIR)
+DEFAULT_PIPE_NAME = "\\\\.\\pipe\\blackfast"
+DEFAULT_MAX_SERVERS = 4
+DEFAULT_STORE_FILE = p(dirs.user_cache_dir, "verified.bfstore")
+
+
+def fnv1a(data: bytes) -> int:
+    # simple enough to be computed the same way by the rust client
+    number = 0xCBF29CE484222325
+    for byte in data:
+        number = ((number ^ byte) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+    return number
+
+
+def get_server_id() -> str:
+    """Identifies the server of the environment blackfast-server is installed
+    in, and so the interpreter and black version it runs with."""
+    server_id = os.environ.get("BLACKFAST_SERVER_ID")
+    if server_id:
+        return server_id
+    script = Path(sys.argv[0])
+    if script.name.startswith("blackfast-server"):
+        scripts = script.resolve().parent
+    else:
+        # not run through the console script, which is usually installed
+        # next to the interpreter. Only its directory is resolved like the
+        # rust client does, the interpreter of a virtualenv links elsewhere.
+        scripts = Path(sys.executable).parent.resolve()
+    return f"{fnv1a(str(scripts).encode('utf-8')):016x}"
+
+
+def get_pid_file() -> Path:
+    return Path(
+        os.environ.get("BLACKFAST_PID", p(SERVERS_DIR, f"{get_server_id()}.pid"))
+    )
+
+
+def get_socket_path() -> str:
+    path = os.environ.get(
+        "BLACKFAST_SOCKET", p(SERVERS_DIR, f"{get_server_id()}.socket")
+    )
+    if len(path) > 100:
+        raise ValueError("Socket path too long")
+    return path
+
+
+def get_pipe_name() -> str:
+    return os.environ.get(
+        "BLACKFAST_PIPE_NAME", f"{DEFAULT_PIPE_NAME}-{get_server_id()}"
+    )
+
+
+def get_max_servers() -> int:
+    return int(os.environ.get("BLACKFAST_MAX_SERVERS", DEFAULT_MAX_SERVERS))
+
+
+def get_address() -> str:
+    if sys.platform == "win32":
+        return get_pipe_name()
+    return get_socket_path()
+
+
+def get_store_file() -> Path:
+    return Path(os.environ.get("BLACKFAST_STORE_FILE", DEFAULT_STORE_FILE))
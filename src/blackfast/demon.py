@@ -1,5 +1,6 @@
 import atexit
 import os
+import select
 import signal
 import subprocess
 import sys
@@ -8,6 +9,9 @@ from pathlib import Path
 from types import FunctionType
 from typing import Optional
 
+# the child writes to this file descriptor once it is ready
+READY_FD = "DEMON_READY_FD"
+
 
 class PidExists(Exception):
     pass
@@ -22,7 +26,9 @@ def spawn(
     func: FunctionType,
     stdout_path: Optional[Path] = None,
     stderr_path: Optional[Path] = None,
-):
+) -> Optional[int]:
+    """Run `func` in a new process. Return a file descriptor to pass to
+    `wait_ready`, or None on Windows where the child cannot signal readiness."""
     kwargs = {}
     try:
         # windows
@@ -31,16 +37,43 @@ def spawn(
     except AttributeError:
         exe = sys.executable
     try:
-        with pid_file.open("x") as fobj:
-            process = subprocess.Popen(
-                [exe, __file__, str(pid_file), func.__module__, func.__name__],
-                stdout=stdout_path and stdout_path.open("w") or subprocess.DEVNULL,
-                stderr=stderr_path and stderr_path.open("w") or subprocess.DEVNULL,
-                **kwargs
-            )
-            fobj.write(str(process.pid))
+        fobj = pid_file.open("x")
     except FileExistsError:
         raise PidExists()
+    read_fd = write_fd = None
+    if sys.platform != "win32":
+        read_fd, write_fd = os.pipe()
+        kwargs["pass_fds"] = (write_fd,)
+        kwargs["env"] = dict(os.environ, **{READY_FD: str(write_fd)})
+    with fobj:
+        process = subprocess.Popen(
+            [exe, __file__, str(pid_file), func.__module__, func.__name__],
+            stdout=stdout_path and stdout_path.open("w") or subprocess.DEVNULL,
+            stderr=stderr_path and stderr_path.open("w") or subprocess.DEVNULL,
+            **kwargs
+        )
+        fobj.write(str(process.pid))
+    if write_fd is not None:
+        os.close(write_fd)
+    return read_fd
+
+
+def wait_ready(fd: int, timeout: float) -> bool:
+    """Wait for the child to call `ready`. Return False if it did not in time
+    or exited before it did."""
+    try:
+        readable, _, _ = select.select([fd], [], [], timeout)
+        return bool(readable) and os.read(fd, 1) == b"\n"
+    finally:
+        os.close(fd)
+
+
+def ready() -> None:
+    """Tell the parent which spawned this process that it is ready."""
+    fd = os.environ.pop(READY_FD, None)
+    if fd is not None:
+        os.write(int(fd), b"\n")
+        os.close(int(fd))
 
 
 def kill(pid_path: Path):
@@ -0,0 +1,294 @@
+import os
+import struct
+import sys
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import *
+from typing import Pattern
+
+import black
+
+# st_mtime_ns, st_size
+Stat = Tuple[int, int]
+
+
+def get_stat(path: Path) -> Stat:
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+if sys.platform.startswith("linux"):
+    import ctypes
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    FILE_CHANGED = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+    DIR_CHANGED = (
+        IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+    )
+    EVENT = struct.Struct("iIII")
+
+    _libc = ctypes.CDLL(None, use_errno=True)
+
+    class Watcher:
+        """Minimal inotify binding, reporting which directories and files
+        changed since it was last asked."""
+
+        def __init__(self) -> None:
+            self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self.fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            self.dirs: Dict[int, Path] = {}
+
+        def watch(self, path: Path) -> bool:
+            wd = _libc.inotify_add_watch(
+                self.fd, os.fsencode(path), FILE_CHANGED | DIR_CHANGED | IN_ONLYDIR
+            )
+            if wd < 0:
+                # most likely out of watches, the caller falls back to stat
+                return False
+            self.dirs[wd] = path
+            return True
+
+        def changes(self) -> Tuple[Set[Path], Set[Path], bool]:
+            """Return changed directories, changed files and whether events
+            were lost."""
+            dirs: Set[Path] = set()
+            files: Set[Path] = set()
+            while True:
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    return dirs, files, False
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = EVENT.unpack_from(data, offset)
+                    name = data[offset + EVENT.size : offset + EVENT.size + length]
+                    offset += EVENT.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        return dirs, files, True
+                    path = self.dirs.get(wd)
+                    if path is None:
+                        continue
+                    if mask & IN_IGNORED:
+                        del self.dirs[wd]
+                        dirs.add(path)
+                        continue
+                    if mask & DIR_CHANGED:
+                        dirs.add(path)
+                    name = name.rstrip(b"\0")
+                    if name:
+                        # files replaced by renaming count as changed too
+                        files.add(path / os.fsdecode(name))
+
+        def close(self) -> None:
+            os.close(self.fd)
+
+
+else:
+    Watcher = None
+
+
+@dataclass
+class Directory:
+    mtime: int
+    watched: bool
+    files: List[Path] = field(default_factory=list)
+    dirs: List[Path] = field(default_factory=list)
+    ignored: List[Tuple[Path, str]] = field(default_factory=list)
+
+
+class Index:
+    """Python files below `root` matching `include` and `exclude`, as found by
+    `black.gen_python_files_in_dir`, along with what we know about their
+    contents.
+
+    Directories are only listed again if inotify reported a change or, where
+    inotify is not available, if their mtime changed. Likewise files are only
+    read again if they changed.
+    """
+
+    def __init__(self, root: Path, include: Pattern[str], exclude: Pattern[str]):
+        self.root = root
+        self.include = include
+        self.exclude = exclude
+        self.dirs: Dict[Path, Directory] = {}
+        self.digests: Dict[Path, Tuple[Stat, bytes]] = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+        if Watcher is not None:
+            try:
+                self.watcher = Watcher()
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def files(self, path: Path, report: black.Report) -> List[Path]:
+        return list(self.walk(path, report))
+
+    def select(
+        self, path: Path, candidates: Iterable[Path], report: black.Report
+    ) -> List[Path]:
+        """Return the `candidates` walking `path` would find, without walking it."""
+        selected = []
+        for candidate in candidates:
+            try:
+                parts = candidate.relative_to(path).parts
+            except ValueError:
+                continue
+            child = path
+            for part in parts[:-1]:
+                child = child / part
+                if self.excluded(child, report, is_dir=True):
+                    break
+            else:
+                if not candidate.is_file() or self.excluded(candidate, report):
+                    continue
+                include_match = self.include.search(self.normalize(candidate))
+                if include_match:
+                    selected.append(candidate)
+        return selected
+
+    def normalize(self, path: Path, is_dir: bool = False) -> str:
+        normalized_path = "/" + path.resolve().relative_to(self.root).as_posix()
+        return normalized_path + "/" if is_dir else normalized_path
+
+    def excluded(self, path: Path, report: black.Report, is_dir: bool = False) -> bool:
+        try:
+            normalized_path = self.normalize(path, is_dir)
+        except ValueError:
+            report.path_ignored(path, f"is outside {self.root}")
+            return True
+        exclude_match = self.exclude.search(normalized_path)
+        if exclude_match and exclude_match.group(0):
+            report.path_ignored(path, f"matches the --exclude regular expression")
+            return True
+        return False
+
+    def known_digests(self, sources: Iterable[Path]) -> Dict[Path, bytes]:
+        """Return the digests of the `sources` which did not change since they
+        were recorded."""
+        with self.lock:
+            self.update()
+            known = {}
+            for src in sources:
+                recorded = self.digests.get(src)
+                if recorded is None:
+                    continue
+                stat, digest = recorded
+                if not self.is_watched(src.parent):
+                    try:
+                        if get_stat(src) != stat:
+                            continue
+                    except OSError:
+                        continue
+                known[src] = digest
+            return known
+
+    def record(self, src: Path, stat: Stat, digest: bytes) -> None:
+        """Remember the `digest` of `src` as it was when its stat was `stat`."""
+        with self.lock:
+            try:
+                # if it changed meanwhile, the event might already be processed
+                if get_stat(src) != stat:
+                    return
+            except OSError:
+                return
+            self.digests[src] = (stat, digest)
+
+    def is_watched(self, path: Path) -> bool:
+        directory = self.dirs.get(path)
+        return directory is not None and directory.watched
+
+    def update(self) -> None:
+        if self.watcher is None:
+            return
+        dirs, files, overflowed = self.watcher.changes()
+        if overflowed:
+            for directory in self.dirs.values():
+                directory.watched = False
+            return
+        for path in dirs:
+            self.dirs.pop(path, None)
+        for path in files:
+            self.digests.pop(path, None)
+
+    def walk(self, path: Path, report: black.Report) -> Iterator[Path]:
+        """Yield the files below `path` as they are found. The index is only
+        locked while listing a directory, so they can be formatted while the
+        walk goes on."""
+        with self.lock:
+            self.update()
+        pending = [path]
+        while pending:
+            with self.lock:
+                directory = self.listing(pending.pop())
+            for child, message in directory.ignored:
+                report.path_ignored(child, message)
+            yield from directory.files
+            pending.extend(reversed(directory.dirs))
+
+    def listing(self, path: Path) -> Directory:
+        directory = self.dirs.get(path)
+        if directory is None or not directory.watched:
+            mtime = path.stat().st_mtime_ns
+            if directory is None or directory.mtime != mtime:
+                directory = self.scan(path, mtime)
+        return directory
+
+    def scan(self, path: Path, mtime: int) -> Directory:
+        watched = self.watcher is not None and self.watcher.watch(path)
+        directory = Directory(mtime, watched)
+        for child in path.iterdir():
+            try:
+                normalized_path = (
+                    "/" + child.resolve().relative_to(self.root).as_posix()
+                )
+            except ValueError:
+                if child.is_symlink():
+                    directory.ignored.append(
+                        (child, f"is a symbolic link that points outside {self.root}")
+                    )
+                    continue
+
+                raise
+
+            if child.is_dir():
+                normalized_path += "/"
+            exclude_match = self.exclude.search(normalized_path)
+            if exclude_match and exclude_match.group(0):
+                directory.ignored.append(
+                    (child, f"matches the --exclude regular expression")
+                )
+                continue
+
+            if child.is_dir():
+                directory.dirs.append(child)
+            elif child.is_file():
+                include_match = self.include.search(normalized_path)
+                if include_match:
+                    directory.files.append(child)
+        self.dirs[path] = directory
+        return directory
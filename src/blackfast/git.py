@@ -0,0 +1,54 @@
+import subprocess
+from pathlib import Path
+from typing import *
+
+
+class GitError(Exception):
+    pass
+
+
+def run(directory: Path, *args: str) -> List[str]:
+    """Run git in `directory`, returning the NUL separated names it prints."""
+    try:
+        result = subprocess.run(
+            ["git", *args],
+            cwd=str(directory),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as exc:
+        raise GitError(f"cannot run git: {exc}")
+    if result.returncode:
+        message = result.stderr.decode("utf-8", "replace").strip()
+        raise GitError(message.splitlines()[0] if message else f"git {args[0]} failed")
+    return [
+        name
+        for name in result.stdout.decode("utf-8", "surrogateescape").split("\0")
+        if name
+    ]
+
+
+def changed_files(
+    directory: Path, since: Optional[str] = None, staged: bool = False
+) -> Set[Path]:
+    """Files below `directory` which changed since the commit `since`, HEAD by
+    default. With `staged` only changes staged for commit count, otherwise
+    changes in the work tree and new files git does not ignore do too. Deleted
+    files are left out.
+    """
+    if since is not None and since.startswith("-"):
+        # it would be taken for an option
+        raise GitError(f"not a revision: {since}")
+    # outside of a repository git diff compares the given paths instead
+    run(directory, "rev-parse", "--git-dir")
+    diff = ["diff", "--name-only", "--relative", "--diff-filter=d", "-z"]
+    if staged:
+        diff.append("--cached")
+    if since is not None:
+        diff.append(since)
+    elif not staged:
+        diff.append("HEAD")
+    names = run(directory, *diff, "--")
+    if not staged:
+        names += run(directory, "ls-files", "--others", "--exclude-standard", "-z")
+    return {directory / name for name in names}
@@ -1,18 +1,46 @@
 import asyncio
 import logging
+import os
+import socket
+import stat
 import sys
 from pathlib import Path
 from typing import Awaitable, Callable, Union
 
 PathLike = Union[Path, str]
 Callback = Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]]
+# connections waiting to be accepted while the server starts
+BACKLOG = 128
 
 
-async def run(unix_path: PathLike, windows_name: str, callback: Callback) -> None:
+async def run(
+    unix_path: PathLike,
+    windows_name: str,
+    callback: Callback,
+    prepare: Callable[[], Awaitable[None]],
+    ready: Callable[[], None],
+) -> None:
+    """Serve `callback` once `prepare` is done. `ready` is called as soon as
+    clients can connect, which on unix is before `prepare` runs: connections
+    wait in the listen backlog until the server starts accepting them."""
     name = windows_name if sys.platform == "win32" else str(unix_path)
-    server = await start_server(callback, name)
+    if sys.platform == "win32":
+        # named pipes accept connections right away
+        await prepare()
+        server = await start_server(callback, name)
+        ready()
+    else:
+        server = await asyncio.start_unix_server(
+            callback, sock=listen(name), start_serving=False
+        )
+        ready()
+        await prepare()
     logging.info(f"Running at {name}")
-    await server.serve_forever()
+    try:
+        await server.serve_forever()
+    finally:
+        if sys.platform != "win32":
+            os.remove(name)
 
 
 if sys.platform == "win32":
@@ -29,3 +57,16 @@ if sys.platform == "win32":
 
 else:
     start_server = asyncio.start_unix_server
+
+    def listen(path: str) -> socket.socket:
+        # asyncio only starts listening once it accepts connections
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                # left behind by a server that did not stop cleanly
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        sock.bind(path)
+        sock.listen(BACKLOG)
+        return sock
@@ -0,0 +1,201 @@
+import bisect
+import math
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import *
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    math.inf,
+)
+QUANTILES = (0.5, 0.95, 0.99)
+# the order phases of a request happen in
+PHASES = ("root", "parse", "discovery", "format", "output")
+
+
+def bound_name(bound: float) -> Union[float, str]:
+    # infinity is not valid JSON
+    return "+Inf" if bound == math.inf else bound
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket the `q` quantile falls into."""
+        if not self.count:
+            return 0.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            buckets[str(bound_name(bound))] = cumulative
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": buckets,
+            **{f"p{int(q * 100)}": bound_name(self.quantile(q)) for q in QUANTILES},
+        }
+
+
+class PoolUsage:
+    """Tracks how many tasks are submitted to a pool of `workers` and how busy
+    that kept it."""
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.pending = 0
+        self.busy_time = 0.0
+        self.started = self.since = time.monotonic()
+
+    def update(self, delta: int) -> None:
+        now = time.monotonic()
+        self.busy_time += min(self.pending, self.workers) * (now - self.since)
+        self.since = now
+        self.pending += delta
+
+    @contextmanager
+    def task(self) -> Iterator[None]:
+        self.update(1)
+        try:
+            yield
+        finally:
+            self.update(-1)
+
+    def as_dict(self) -> Dict[str, Any]:
+        self.update(0)
+        elapsed = self.since - self.started
+        return {
+            "workers": self.workers,
+            "busy": min(self.pending, self.workers),
+            "queued": max(self.pending - self.workers, 0),
+            "utilization": elapsed and self.busy_time / (self.workers * elapsed),
+        }
+
+
+class Metrics:
+    """What the server did since it started."""
+
+    def __init__(self, workers: int) -> None:
+        self.started = time.monotonic()
+        self.active = 0
+        self.requests = Histogram()
+        self.phases: Dict[str, Histogram] = defaultdict(Histogram)
+        # as measured by workers sending back compact results
+        self.formatting = Histogram()
+        self.counters: Counter = Counter()
+        self.pool = PoolUsage(workers)
+
+    @contextmanager
+    def request(self) -> Iterator[None]:
+        self.active += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.requests.observe(time.monotonic() - start)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name].observe(time.monotonic() - start)
+
+    def as_dict(self, **extra: Any) -> Dict[str, Any]:
+        return {
+            "uptime": time.monotonic() - self.started,
+            "active_requests": self.active,
+            "requests": self.requests.as_dict(),
+            "phases": {name: hist.as_dict() for name, hist in self.phases.items()},
+            "formatting": self.formatting.as_dict(),
+            "counters": dict(self.counters),
+            "pool": self.pool.as_dict(),
+            **extra,
+        }
+
+
+def format_text(stats: Dict[str, Any]) -> str:
+    def latency(hist: Dict[str, Any]) -> str:
+        mean = hist["sum"] / hist["count"] if hist["count"] else 0
+        quantiles = ", ".join(
+            f"p{int(q * 100)} <= {hist[f'p{int(q * 100)}']}s" for q in QUANTILES
+        )
+        return f"{hist['count']}, mean {mean:.4f}s, {quantiles}"
+
+    pool = stats["pool"]
+    lines = [
+        f"uptime: {stats['uptime']:.0f}s",
+        f"active requests: {stats['active_requests']}",
+        f"requests: {latency(stats['requests'])}",
+        "phases:",
+        *(
+            f"  {name}: {latency(stats['phases'][name])}"
+            for name in PHASES
+            if name in stats["phases"]
+        ),
+        f"formatting in workers: {latency(stats['formatting'])}",
+        "counters:",
+        *(f"  {name}: {count}" for name, count in sorted(stats["counters"].items())),
+        f"pool: {pool['workers']} workers, {pool['busy']} busy, "
+        f"{pool['queued']} queued, {pool['utilization']:.1%} utilization",
+    ]
+    if "workers" in stats:
+        replaced = ", ".join(
+            f"{count} for {reason}"
+            for reason, count in sorted(stats["workers"]["replaced"].items())
+        )
+        lines.append(
+            f"workers: {'running' if stats['workers']['running'] else 'stopped'}, "
+            f"replaced {replaced or 'never'}"
+        )
+    if "scheduler" in stats:
+        lines.append(
+            "scheduler: {running} running, {reserved} reserved for interactive "
+            "requests, waiting {interactive} interactive and {bulk} bulk".format(
+                **stats["scheduler"], **stats["scheduler"]["waiting"]
+            )
+        )
+    if "cache" in stats:
+        lines.append(
+            "cache: {entries} entries, {size} of {max_size} bytes".format(
+                **stats["cache"]
+            )
+        )
+    if "store" in stats:
+        lines.append(
+            "store: {entries} verified sources in {path}".format(**stats["store"])
+        )
+    return "\n".join(lines) + "\n"
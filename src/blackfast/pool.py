@@ -0,0 +1,307 @@
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+from collections import Counter
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from enum import IntEnum
+from functools import partial
+from typing import *
+
+from .worker import measured, warm_up
+
+T = TypeVar("T")
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class TaskFuture(Future):
+    """The result of a task, cancelling it cancels the task in the worker pool."""
+
+    def __init__(self, inner: Future, executor: ProcessPoolExecutor) -> None:
+        super().__init__()
+        self.inner = inner
+        self.executor = executor
+        # pid to process of the workers which might run the task
+        self.processes: Dict[int, multiprocessing.Process] = executor._processes
+        self.killed = False
+        # when it was last submitted, retrying it starts over
+        self.started = time.monotonic()
+
+    def cancel(self) -> bool:
+        return self.inner.cancel() and super().cancel()
+
+
+class Pool(Executor):
+    """A pool of `workers` processes, started with `start_method` or the platform
+    default, which replaces its workers before they grow too big.
+
+    Workers are replaced all at once: once they ran `max_tasks` tasks each on
+    average, or one of them uses more than `max_memory` bytes after a task, new
+    tasks go to new workers while the old ones finish the tasks they have and
+    exit. After `idle_timeout` seconds without tasks the workers exit too, the
+    next task starts new ones. Zero disables either limit.
+
+    Tasks can be killed, along with the workers running them, see `kill`.
+
+    With the "fork" start method only the workers of `start` are forked from
+    this process, which must not run other threads yet. Later workers would
+    inherit locks those threads hold, so they are forked from a fork server.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        start_method: Optional[str],
+        max_tasks: int = 0,
+        max_memory: int = 0,
+        idle_timeout: float = 0,
+    ) -> None:
+        self.workers = workers
+        self.context = multiprocessing.get_context(start_method)
+        self.later_context = self.context
+        if (
+            self.context.get_start_method() == "fork"
+            and "forkserver" in multiprocessing.get_all_start_methods()
+        ):
+            self.later_context = multiprocessing.get_context("forkserver")
+        if self.later_context.get_start_method() == "forkserver":
+            # loaded once by the fork server, which the workers are forked from
+            self.later_context.set_forkserver_preload(["black", "blackfast.worker"])
+        self.max_tasks = max_tasks
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.executor: Optional[ProcessPoolExecutor] = None
+        # tasks submitted to the current executor, and not done yet
+        self.tasks = 0
+        self.pending = 0
+        self.last_used = time.monotonic()
+        # why workers were replaced
+        self.events: Counter = Counter()
+        self.killed: "weakref.WeakSet[ProcessPoolExecutor]" = weakref.WeakSet()
+
+    def start(self) -> List[Future]:
+        """Start all workers without waiting until they are ready, tasks
+        submitted meanwhile go to the first one which is. Returns the futures of
+        a no-op task per worker, done as the workers get ready."""
+        if self.context.get_start_method() == "fork":
+            # the workers inherit whatever is loaded here
+            warm_up()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    self.workers, mp_context=self.context, initializer=warm_up
+                )
+        # the executor may only start a worker per task
+        return [self.submit(os.getpid) for _ in range(self.workers)]
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        return self.run(None, partial(fn, *args, **kwargs))
+
+    def run(self, outer: Optional[TaskFuture], task: Callable[[], Any]) -> TaskFuture:
+        """Run `task` for `outer`, or a new future if it is None."""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    self.workers, mp_context=self.later_context, initializer=warm_up
+                )
+            executor = self.executor
+            inner = executor.submit(measured, task)
+            self.tasks += 1
+            self.pending += 1
+            self.last_used = time.monotonic()
+            if self.max_tasks and self.tasks >= self.max_tasks * self.workers:
+                self.retire("max_tasks")
+        if outer is None:
+            outer = TaskFuture(inner, executor)
+        else:
+            outer.inner = inner
+            outer.executor = executor
+            outer.processes = executor._processes
+            outer.started = time.monotonic()
+        inner.add_done_callback(partial(self.done, outer, task))
+        return outer
+
+    def done(self, outer: TaskFuture, task: Callable[[], Any], inner: Future) -> None:
+        with self.lock:
+            self.pending -= 1
+            self.last_used = time.monotonic()
+        if inner.cancelled():
+            Future.cancel(outer)
+            return
+        exc = inner.exception()
+        if isinstance(exc, BrokenProcessPool) and outer.killed:
+            outer.set_exception(TaskTimeout("its worker was killed"))
+        elif isinstance(exc, BrokenProcessPool) and outer.executor in self.killed:
+            # killed along with another task
+            with self.lock:
+                self.events["retried"] += 1
+            self.run(outer, task)
+        elif exc is not None:
+            outer.set_exception(exc)
+        else:
+            result, memory = inner.result()
+            if self.max_memory and memory > self.max_memory:
+                with self.lock:
+                    if self.executor is outer.executor:
+                        self.retire("max_memory")
+            outer.set_result(result)
+
+    def kill(self, future: Future) -> None:
+        """Kill the task of `future`, a future returned by this pool, by killing
+        the workers which might run it. Their other tasks run again on new
+        workers."""
+        outer = cast(TaskFuture, future)
+        outer.killed = True
+        with self.lock:
+            if self.executor is outer.executor:
+                self.retire("timeout")
+            self.killed.add(outer.executor)
+        for process in list(outer.processes.values()):
+            process.kill()
+
+    def retire(self, reason: str) -> None:
+        """Have the current workers exit once their tasks are done, new tasks go
+        to new workers. Call with the lock held."""
+        if self.executor is not None:
+            # waiting in another thread, before Python 3.9 shutdown(wait=False)
+            # closes pipes the executor needs to finish its tasks
+            threading.Thread(target=self.executor.shutdown, daemon=True).start()
+            self.executor = None
+            self.tasks = 0
+            self.events[reason] += 1
+
+    def shrink_if_idle(self) -> None:
+        with self.lock:
+            idle = time.monotonic() - self.last_used
+            if self.idle_timeout and not self.pending and idle >= self.idle_timeout:
+                self.retire("idle")
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"running": self.executor is not None, "replaced": dict(self.events)}
+
+
+class Priority(IntEnum):
+    # lower runs first
+    INTERACTIVE = 0
+    BULK = 1
+
+
+class Scheduler:
+    """Runs tasks in `executor`, no more than `slots` at a time. Waiting
+    interactive tasks run before bulk ones, so an editor formatting on save does
+    not wait for a run over a whole repository, and `reserved` slots are kept
+    free for them. Otherwise waiting tasks run biggest first, so a huge file does
+    not end up running last while the other workers idle.
+
+    Sizes only order the tasks waiting at a time, callers submitting many should
+    submit the biggest first too.
+
+    Tasks running longer than `timeout` seconds fail with `TaskTimeout`. If
+    `executor` is a `Pool` the workers running them are killed and replaced,
+    otherwise they are only abandoned. Tasks the pool retries, because their
+    worker was killed along with another task, get the whole timeout again.
+    """
+
+    def __init__(
+        self, executor: Executor, slots: int, timeout: float = 0, reserved: int = 0
+    ) -> None:
+        self.executor = executor
+        self.slots = slots
+        self.timeout = timeout
+        # at least one slot is left for bulk tasks
+        self.reserved = max(min(reserved, slots - 1), 0)
+        self.running = 0
+        # priority, negated size, to break ties, the future resolved once it may run
+        self.waiting: List[Tuple[Priority, int, int, "asyncio.Future[None]"]] = []
+        self.order = itertools.count()
+
+    async def run(
+        self,
+        size: int,
+        fn: Callable[..., T],
+        *args: Any,
+        priority: Priority = Priority.BULK,
+    ) -> T:
+        turn = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting, (priority, -size, next(self.order), turn))
+        self.dispatch()
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # handed a slot right before
+                self.release()
+            raise
+        try:
+            return await self.execute(fn, *args)
+        finally:
+            self.release()
+
+    def limit(self, priority: Priority) -> int:
+        return (
+            self.slots
+            if priority is Priority.INTERACTIVE
+            else self.slots - self.reserved
+        )
+
+    def dispatch(self) -> None:
+        """Start waiting tasks while there are free slots for them."""
+        while self.waiting:
+            priority, _, _, turn = self.waiting[0]
+            if turn.done():
+                # cancelled
+                heapq.heappop(self.waiting)
+            elif self.running < self.limit(priority):
+                heapq.heappop(self.waiting)
+                self.running += 1
+                turn.set_result(None)
+            else:
+                return
+
+    def release(self) -> None:
+        self.running -= 1
+        self.dispatch()
+
+    def as_dict(self) -> Dict[str, Any]:
+        waiting = {priority.name.lower(): 0 for priority in Priority}
+        for priority, _, _, turn in self.waiting:
+            if not turn.done():
+                waiting[priority.name.lower()] += 1
+        return {"running": self.running, "reserved": self.reserved, "waiting": waiting}
+
+    async def execute(self, fn: Callable[..., T], *args: Any) -> T:
+        future = self.executor.submit(fn, *args)
+        result = asyncio.wrap_future(future)
+        if not self.timeout:
+            return await result
+        started = time.monotonic()
+        try:
+            while True:
+                if isinstance(future, TaskFuture):
+                    started = future.started
+                remaining = started + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.wait([result], timeout=remaining)
+                if result.done():
+                    return result.result()
+        finally:
+            result.cancel()
+        if isinstance(self.executor, Pool):
+            self.executor.kill(future)
+        raise TaskTimeout(f"took longer than {self.timeout:g} seconds")
@@ -0,0 +1,91 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import *
+from typing import Pattern
+
+import black
+import click
+import toml
+
+# st_mtime_ns and st_ino of a file, None if it does not exist
+Stamp = Optional[Tuple[int, int]]
+
+
+def get_stamp(path: Path) -> Stamp:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_ino
+
+
+def get_stamps(work_dir: Path, root: Path) -> Tuple[Stamp, ...]:
+    """Stamps of the pyproject.toml files from `work_dir` up to `root`. Other
+    than changing the configuration, a new one moves the project root."""
+    stamps = []
+    for directory in (work_dir, *work_dir.parents):
+        stamps.append(get_stamp(directory / "pyproject.toml"))
+        if directory == root:
+            break
+    return tuple(stamps)
+
+
+@dataclass
+class Project:
+    work_dir: Path
+    root: Path
+    # the pyproject.toml configuring black, if any
+    config_file: Optional[str]
+    # the options it sets, as a click default map
+    defaults: Dict[str, Any]
+    stamps: Tuple[Stamp, ...]
+    regexes: Dict[str, Pattern[str]] = field(default_factory=dict)
+
+    def compile(self, regex: str) -> Pattern[str]:
+        """`black.re_compile_maybe_verbose`, but only once per project."""
+        try:
+            return self.regexes[regex]
+        except KeyError:
+            compiled = self.regexes[regex] = black.re_compile_maybe_verbose(regex)
+            return compiled
+
+
+def load(work_dir: Path) -> Project:
+    work_dir = work_dir.resolve()
+    # the cached version would never notice new project roots
+    root = black.find_project_root.__wrapped__((str(work_dir),))
+    stamps = get_stamps(work_dir, root)
+    path = root / "pyproject.toml"
+    if not path.is_file():
+        return Project(work_dir, root, None, {}, stamps)
+    try:
+        config = toml.load(str(path)).get("tool", {}).get("black", {})
+    except (toml.TomlDecodeError, OSError) as e:
+        raise click.BadOptionUsage(f"Error reading configuration file: {e}")
+    defaults = {k.replace("--", "").replace("-", "_"): v for k, v in config.items()}
+    return Project(work_dir, root, str(path) if config else None, defaults, stamps)
+
+
+class Projects:
+    """The projects of the last `max_size` work dirs. A project is loaded again
+    once a pyproject.toml it depends on changed."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.projects: "OrderedDict[Path, Project]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, work_dir: Path) -> Project:
+        with self.lock:
+            project = self.projects.get(work_dir)
+            if project is not None:
+                if get_stamps(project.work_dir, project.root) == project.stamps:
+                    self.projects.move_to_end(work_dir)
+                    return project
+            project = self.projects[work_dir] = load(work_dir)
+            self.projects.move_to_end(work_dir)
+            if len(self.projects) > self.max_size:
+                self.projects.popitem(last=False)
+            return project
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import socket
+import struct
+import sys
+from enum import IntEnum
+from typing import *
+from typing import BinaryIO
+
+# Bump this whenever the frames or their payloads change in an incompatible way.
+VERSION = 3
+
+# frame type, request id, payload length
+HEADER = struct.Struct("<BII")
+U32 = struct.Struct("<I")
+I32 = struct.Struct("<i")
+
+
+class Frame(IntEnum):
+    """A connection carries any number of requests, which may be in progress at
+    the same time. All frames but HELLO and ERROR carry the id of the request
+    they belong to, chosen by the client. Responses complete in any order."""
+
+    # both ways, u32 protocol version. Always the first frame.
+    HELLO = 0
+    # client to server, JSON list of arguments. Always the last frame of a request.
+    ARGS = 1
+    # client to server, source to format in place of "-"
+    STDIN = 2
+    # server to client, output chunks
+    STDOUT = 3
+    STDERR = 4
+    # server to client, the formatted source sent as STDIN
+    FORMATTED = 5
+    # server to client, the source sent as STDIN is already well formatted
+    UNCHANGED = 6
+    # server to client, i32 exit code. Always the last frame of a response.
+    EXIT = 7
+    # server to client, utf-8 error message. The connection is closed after it,
+    # failing all requests in progress.
+    ERROR = 8
+    # server to client with --stream, JSON outcome of a single file as soon as
+    # it is known: {"src": path, "status": "changed" | "unchanged" | "failed"}
+    # plus "diff" with --diff and "error" if it failed
+    RESULT = 9
+    # server to client with --stream, JSON counts of "changed", "unchanged" and
+    # "failed" files and the "exit_code", after all RESULT frames
+    SUMMARY = 10
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack(kind: Frame, payload: bytes = b"", request_id: int = 0) -> bytes:
+    return HEADER.pack(kind, request_id, len(payload)) + payload
+
+
+def hello() -> bytes:
+    return pack(Frame.HELLO, U32.pack(VERSION))
+
+
+def exit_code(num: int, request_id: int = 0) -> bytes:
+    return pack(Frame.EXIT, I32.pack(num), request_id)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[Frame, int, bytes]:
+    kind, request_id, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    try:
+        kind = Frame(kind)
+    except ValueError:
+        raise ProtocolError(f"unknown frame type {kind}")
+    return kind, request_id, await reader.readexactly(length)
+
+
+async def handshake(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    kind, _, payload = await read_frame(reader)
+    if kind is not Frame.HELLO or len(payload) != U32.size:
+        raise ProtocolError("expected a hello frame, is the client too old?")
+    writer.write(hello())
+    (version,) = U32.unpack(payload)
+    if version != VERSION:
+        raise ProtocolError(
+            f"client speaks protocol version {version} but the server speaks "
+            f"version {VERSION}, restart the server with `blackfast-server stop`"
+        )
+
+
+async def read_request(
+    reader: asyncio.StreamReader, stdin: Optional[Dict[int, bytes]] = None
+) -> Tuple[int, List[str], Optional[bytes]]:
+    """Read the next request, returning its id, arguments and source to format.
+
+    `stdin` holds the sources of requests which were not complete yet, keep
+    passing the same dict when reading more than one request.
+    """
+    stdin = {} if stdin is None else stdin
+    while True:
+        kind, request_id, payload = await read_frame(reader)
+        if kind is Frame.STDIN:
+            stdin[request_id] = payload
+        elif kind is Frame.ARGS:
+            try:
+                args = json.loads(payload)
+            except ValueError as exc:
+                raise ProtocolError(f"malformed arguments: {exc}") from exc
+            if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
+                raise ProtocolError("arguments must be a list of strings")
+            return request_id, args, stdin.pop(request_id, None)
+        else:
+            raise ProtocolError(f"unexpected {kind.name} frame")
+
+
+def request(
+    address: str,
+    args: List[str],
+    stdout: Optional[BinaryIO] = None,
+    stderr: Optional[BinaryIO] = None,
+    stdin: Optional[bytes] = None,
+) -> int:
+    """Send `args` to the server listening at `address` and relay its output,
+    blocking until it is done. Return the exit code. `stdin` is the source to
+    format if `args` include "-", its formatted version goes to `stdout`."""
+    stdout = stdout or sys.stdout.buffer
+    stderr = stderr or sys.stderr.buffer
+    if sys.platform == "win32":
+        stream = open(address, "r+b", buffering=0)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        stream = sock.makefile("rwb")
+        sock.close()
+    with stream:
+        stream.write(hello())
+        if stdin is not None:
+            stream.write(pack(Frame.STDIN, stdin))
+        stream.write(pack(Frame.ARGS, json.dumps(args).encode("utf-8")))
+        stream.flush()
+        while True:
+            header = stream.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ProtocolError("connection closed by the server")
+            kind, _, length = HEADER.unpack(header)
+            payload = stream.read(length)
+            if kind == Frame.HELLO:
+                if payload != U32.pack(VERSION):
+                    raise ProtocolError("server speaks a different protocol version")
+            elif kind in (Frame.STDOUT, Frame.FORMATTED):
+                stdout.write(payload)
+            elif kind == Frame.UNCHANGED:
+                if stdin is None:
+                    raise ProtocolError("unexpected UNCHANGED frame without stdin")
+                stdout.write(stdin)
+            elif kind in (Frame.RESULT, Frame.SUMMARY):
+                # one JSON document per line
+                stdout.write(payload + b"\n")
+                stdout.flush()
+            elif kind == Frame.STDERR:
+                stderr.write(payload)
+            elif kind == Frame.EXIT:
+                return I32.unpack(payload)[0]
+            elif kind == Frame.ERROR:
+                raise ProtocolError(payload.decode("utf-8"))
+            else:
+                raise ProtocolError(f"unexpected frame type {kind}")
@@ -0,0 +1,72 @@
+import io
+import tokenize
+from typing import *
+
+import click
+
+# first and last line, counting from 1
+LineRange = Tuple[int, int]
+# first line and the line after the last, counting from 0
+Span = Tuple[int, int]
+
+# start a new line, but continue the statement before
+CONTINUATIONS = {"elif", "else", "except", "finally"}
+
+
+def parse(
+    ctx: click.Context, param: click.Parameter, value: Tuple[str, ...]
+) -> Tuple[LineRange, ...]:
+    """click callback turning START-END and LINE into line ranges."""
+    line_ranges = []
+    for line_range in value:
+        try:
+            start, _, end = line_range.partition("-")
+            line_ranges.append((int(start), int(end or start)))
+        except ValueError:
+            raise click.BadParameter(f"{line_range!r} is not START-END")
+        if not 1 <= line_ranges[-1][0] <= line_ranges[-1][1]:
+            raise click.BadParameter(f"{line_range!r} is not a range of lines")
+    return tuple(line_ranges)
+
+
+def overlaps(span: Span, line_ranges: Iterable[LineRange]) -> bool:
+    return any(span[0] < end and start <= span[1] for start, end in line_ranges)
+
+
+def statements(source: str, line_ranges: Sequence[LineRange]) -> List[Span]:
+    """Spans of the top-level statements of `source` overlapping `line_ranges`.
+
+    Decorators and clauses like `else:` belong to the statement they are part of,
+    comments and blank lines between statements to none. Tokenizing stops after
+    the last range, so the rest of the source does not need to be valid.
+    """
+    last = max(end for _, end in line_ranges)
+    spans = []
+    start = None
+    # the line after the end of the last logical line
+    end = 0
+    depth = 0
+    line_start = True
+    decorator = False
+    for token in tokenize.generate_tokens(io.StringIO(source).readline):
+        if token.type == tokenize.INDENT:
+            depth += 1
+        elif token.type == tokenize.DEDENT:
+            depth -= 1
+        elif token.type == tokenize.NEWLINE:
+            end = token.end[0]
+            line_start = True
+        elif token.type in (tokenize.NL, tokenize.COMMENT):
+            continue
+        elif line_start:
+            line_start = False
+            if depth or decorator or token.string in CONTINUATIONS:
+                decorator = decorator and token.string == "@"
+                continue
+            if start is not None and overlaps((start, end), line_ranges):
+                spans.append((start, end))
+            if token.type == tokenize.ENDMARKER or token.start[0] > last:
+                break
+            start = token.start[0] - 1
+            decorator = token.string == "@"
+    return spans
@@ -0,0 +1,91 @@
+import json
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import *
+
+from . import demon
+from .config import SERVERS_DIR
+
+# a server records that it was used at most this often, in seconds
+TOUCH_INTERVAL = 60
+
+_touched: Dict[str, float] = {}
+
+
+def info_file(server_id: str) -> Path:
+    return Path(SERVERS_DIR) / f"{server_id}.json"
+
+
+def register(server_id: str, info: Dict[str, Any]) -> None:
+    info_file(server_id).write_text(json.dumps(info))
+
+
+def unregister(server_id: str) -> None:
+    try:
+        info_file(server_id).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def touch(server_id: str) -> None:
+    """Record that the server was just used."""
+    now = time.monotonic()
+    if now - _touched.get(server_id, -TOUCH_INTERVAL) < TOUCH_INTERVAL:
+        return
+    _touched[server_id] = now
+    try:
+        os.utime(info_file(server_id))
+    except FileNotFoundError:
+        pass
+
+
+def servers() -> List[Tuple[str, float, Dict[str, Any]]]:
+    """Return the id, the time of last use and the info of registered servers,
+    most recently used first."""
+    found = []
+    for path in Path(SERVERS_DIR).glob("*.json"):
+        try:
+            found.append(
+                (path.stem, path.stat().st_mtime, json.loads(path.read_text()))
+            )
+        except (OSError, ValueError):
+            continue
+    return sorted(found, key=lambda server: server[1], reverse=True)
+
+
+def answers(address: str) -> bool:
+    """Whether a server accepts connections at `address`."""
+    try:
+        if sys.platform == "win32":
+            open(address, "r+b", buffering=0).close()
+        else:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(address)
+    except OSError:
+        return False
+    return True
+
+
+def stop(server_id: str, info: Dict[str, Any]) -> None:
+    """Stop the server and unregister it. Servers which do not answer anymore
+    are only unregistered, their pid might belong to another process by now."""
+    if answers(info.get("address", "")):
+        try:
+            demon.kill(Path(info["pid_file"]))
+        except demon.PidDoesNotExist:
+            pass
+        except ProcessLookupError:
+            # it did not stop cleanly
+            Path(info["pid_file"]).unlink()
+    unregister(server_id)
+
+
+def evict(keep: str, limit: int) -> None:
+    """Stop the least recently used servers, so at most `limit` servers other
+    than `keep` keep running."""
+    others = [server for server in servers() if server[0] != keep]
+    for server_id, _, info in others[limit:]:
+        stop(server_id, info)
@@ -1,78 +1,432 @@
 import asyncio
+import io
+import itertools
 import json
+import logging
 import os
 import re
-import socket
-import struct
-import sys
-import time
-from concurrent.futures import ProcessPoolExecutor
-from contextvars import ContextVar
+import signal
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar, copy_context
 from dataclasses import dataclass
+from datetime import datetime
 from functools import partial
 from pathlib import Path
 from typing import *
+from typing import Pattern
 
-import appdirs
 import black
 import click
 
-from . import ipcserver
-from . import demon
+from . import cache
+from . import discovery
+from . import git
+from . import metrics
+from . import pool
+from . import protocol
+from . import ranges
+from . import store
+from .config import dirs, get_store_file, p
+from .project import Project, Projects
+from .protocol import Frame
+from .worker import diff_hunks, format_bytes, format_compact, verify_bytes
 
-p = lambda b, n: str((Path(b) / n).absolute())
+DEFAULT_CACHE_FILE = p(dirs.user_cache_dir, f"format-cache.{black.__version__}.pickle")
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_CACHE_FLUSH_INTERVAL = 300
+DEFAULT_WATCH_INTERVAL = 2
+DEFAULT_MAX_TASKS_PER_WORKER = 1000
+DEFAULT_MAX_WORKER_MEMORY = 512
+DEFAULT_IDLE_TIMEOUT = 900
+DEFAULT_FORMAT_TIMEOUT = 60
+DEFAULT_RESERVED_WORKERS = 0
+# requests for at most this many files are interactive, like an editor
+# formatting on save, unless --priority says otherwise
+INTERACTIVE_SOURCES = 4
+# files a request finds at a time, and reads and formats at the same time
+BATCH_SIZE = 256
+MAX_IN_PROGRESS = 256
+# the exit code of requests cancelled by a later one, see --supersede
+SUPERSEDED = 3
+# how often to check whether the workers are idle, in seconds
+IDLE_CHECK_INTERVAL = 10
+MAX_INDEXES = 8
+MAX_PROJECTS = 64
+# wait this long after a change is reported for more changes, editors tend to
+# write files in several steps
+WATCH_DELAY = 0.1
 
+# flush batched output once it grows past this many bytes
+FLUSH_SIZE = 64 * 1024
 
-def ensure(*paths: str) -> None:
-    for path in paths:
-        path = Path(path)
-        if not path.exists():
-            path.mkdir(parents=True)
 
+def get_cache_file() -> Path:
+    return Path(os.environ.get("BLACKFAST_CACHE_FILE", DEFAULT_CACHE_FILE))
 
-dirs = appdirs.AppDirs("blackfast")
-ensure(dirs.user_data_dir, dirs.user_log_dir)
-STDOUT_LOG = p(dirs.user_log_dir, "stdout.log")
-STDERR_LOG = p(dirs.user_log_dir, "stderr.log")
-DEFAULT_SOCKET_PATH = p(dirs.user_data_dir, "blackfast.socket")
-DEFAULT_PIPE_NAME = "\\\\.\\pipe\\blackfast"
-DEFAULT_PID_FILE = p(dirs.user_data_dir, "blackfast.pid")
 
-PROCESS_POOL = ProcessPoolExecutor()
+def get_cache_size() -> int:
+    return int(os.environ.get("BLACKFAST_CACHE_SIZE", DEFAULT_CACHE_SIZE))
 
-STDOUT = ContextVar("STDOUT", default=sys.stdout)
 
+def get_cache_flush_interval() -> float:
+    return float(
+        os.environ.get("BLACKFAST_CACHE_FLUSH_INTERVAL", DEFAULT_CACHE_FLUSH_INTERVAL)
+    )
+
+
+def get_workers() -> int:
+    return int(os.environ.get("BLACKFAST_WORKERS", 0)) or os.cpu_count() or 1
+
+
+def get_start_method() -> Optional[str]:
+    return os.environ.get("BLACKFAST_START_METHOD") or None
+
+
+def get_watch_interval() -> float:
+    return float(os.environ.get("BLACKFAST_WATCH_INTERVAL", DEFAULT_WATCH_INTERVAL))
+
+
+def get_max_tasks_per_worker() -> int:
+    return int(
+        os.environ.get("BLACKFAST_MAX_TASKS_PER_WORKER", DEFAULT_MAX_TASKS_PER_WORKER)
+    )
+
+
+def get_max_worker_memory() -> int:
+    """In bytes, configured in megabytes."""
+    megabytes = os.environ.get("BLACKFAST_MAX_WORKER_MEMORY", DEFAULT_MAX_WORKER_MEMORY)
+    return int(megabytes) * 1024 * 1024
+
+
+def get_idle_timeout() -> float:
+    return float(os.environ.get("BLACKFAST_IDLE_TIMEOUT", DEFAULT_IDLE_TIMEOUT))
+
+
+def get_format_timeout() -> float:
+    return float(os.environ.get("BLACKFAST_FORMAT_TIMEOUT", DEFAULT_FORMAT_TIMEOUT))
+
+
+def get_reserved_workers() -> int:
+    return int(os.environ.get("BLACKFAST_RESERVED_WORKERS", DEFAULT_RESERVED_WORKERS))
+
+
+PROCESS_POOL = pool.Pool(
+    get_workers(),
+    get_start_method(),
+    max_tasks=get_max_tasks_per_worker(),
+    max_memory=get_max_worker_memory(),
+    idle_timeout=get_idle_timeout(),
+)
+SCHEDULER = pool.Scheduler(
+    PROCESS_POOL,
+    get_workers(),
+    timeout=get_format_timeout(),
+    reserved=get_reserved_workers(),
+)
+CACHE = cache.FormatCache(get_cache_size())
+STORE = store.Store(get_store_file())
+PROJECTS = Projects(MAX_PROJECTS)
+METRICS = metrics.Metrics(get_workers())
+IndexKey = Tuple[Path, str, str]
+INDEXES: "OrderedDict[IndexKey, discovery.Index]" = OrderedDict()
+# requests using each index, evicted indexes are closed once none is left
+INDEX_USERS: Counter = Counter()
+
+
+def get_index(
+    root: Path, include: Pattern[str], exclude: Pattern[str]
+) -> discovery.Index:
+    key = (root, include.pattern, exclude.pattern)
+    try:
+        INDEXES.move_to_end(key)
+        return INDEXES[key]
+    except KeyError:
+        pass
+    index = INDEXES[key] = discovery.Index(root, include, exclude)
+    if len(INDEXES) > MAX_INDEXES:
+        for evicted_key, evicted in INDEXES.items():
+            # watched indexes are kept until the server stops
+            if evicted_key not in WATCHES:
+                del INDEXES[evicted_key]
+                if not INDEX_USERS[evicted]:
+                    evicted.close()
+                break
+    return index
+
+
+@contextmanager
+def lease_index(
+    root: Path, include: Pattern[str], exclude: Pattern[str]
+) -> Iterator[discovery.Index]:
+    """Like `get_index`, keeping the index open until the lease ends even if it
+    gets evicted meanwhile."""
+    index = get_index(root, include, exclude)
+    INDEX_USERS[index] += 1
+    try:
+        yield index
+    finally:
+        INDEX_USERS[index] -= 1
+        if not INDEX_USERS[index]:
+            del INDEX_USERS[index]
+            if INDEXES.get((root, include.pattern, exclude.pattern)) is not index:
+                index.close()
 
-def get_pid_file() -> Path:
-    return Path(os.environ.get("BLACKFAST_PID", DEFAULT_PID_FILE))
 
+# line length, fast, mode
+Options = Tuple[int, bool, black.FileMode]
+
+
+class Watch:
+    """Keeps the results for the files below some directories of an index in
+    the format cache, so requests for them do not have to format anything.
+
+    Changes are picked up through inotify where the index uses it, by polling
+    every `get_watch_interval()` seconds otherwise. Nothing is ever written.
+    Contents which failed to format are only tried again once they change.
+    """
+
+    def __init__(self, index: discovery.Index) -> None:
+        self.index = index
+        self.paths: Set[Path] = set()
+        self.options: Set[Options] = set()
+        # cache keys and fast of the contents which failed to format
+        self.failed: Set[Tuple[cache.Key, bool]] = set()
+        self.task = asyncio.ensure_future(self.run())
+
+    def add(self, paths: Iterable[Path], options: Options) -> None:
+        self.paths.update(paths)
+        self.options.add(options)
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        watcher = self.index.watcher
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logging.warning(f"Refreshing {self.index.root} failed: {exc}")
+            if watcher is None:
+                await asyncio.sleep(get_watch_interval())
+                continue
+            changed = loop.create_future()
+            loop.add_reader(
+                watcher.fd, lambda: changed.done() or changed.set_result(None)
+            )
+            try:
+                # requests drain the events too, so look again every now and then
+                await asyncio.wait([changed], timeout=get_watch_interval())
+            finally:
+                loop.remove_reader(watcher.fd)
+            await asyncio.sleep(WATCH_DELAY)
+
+    async def refresh(self) -> None:
+        report = black.Report(quiet=True)
+        files: Set[Path] = set()
+        for path in list(self.paths):
+            try:
+                files.update(await run_in_thread(self.index.files, path, report))
+            except OSError:
+                continue
+        known = await run_in_thread(self.index.known_digests, files)
+        # forget the failures of contents which changed since
+        digests = set(known.values())
+        self.failed = {f for f in self.failed if f[0][0] in digests}
+        # like format_sources, at most MAX_IN_PROGRESS files at a time
+        slots = asyncio.Semaphore(MAX_IN_PROGRESS)
+        tasks: Set["asyncio.Future[None]"] = set()
+        try:
+            for src in files:
+                for options in list(self.options):
+                    if self.is_settled(src, known.get(src), *options):
+                        continue
+                    await slots.acquire()
+                    task = asyncio.ensure_future(self.precheck(src, *options))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    task.add_done_callback(lambda _: slots.release())
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def is_settled(
+        self,
+        src: Path,
+        digest: Optional[bytes],
+        line_length: int,
+        fast: bool,
+        mode: black.FileMode,
+    ) -> bool:
+        """Whether `src` was cached or failed to format with these contents."""
+        if digest is None:
+            return False
+        if src.suffix == ".pyi":
+            mode |= black.FileMode.PYI
+        key = cache.make_key(digest, line_length, mode)
+        return (key, fast) in self.failed or lookup(key, fast) is not None
+
+    async def precheck(
+        self, src: Path, line_length: int, fast: bool, mode: black.FileMode
+    ) -> None:
+        if src.suffix == ".pyi":
+            mode |= black.FileMode.PYI
+        try:
+            _, contents, digest = await run_in_thread(read_source, src, self.index)
+        except OSError:
+            # reported once a request asks for the file
+            return
+        key = cache.make_key(digest, line_length, mode)
+        if (key, fast) in self.failed:
+            return
+        try:
+            await format_cached(
+                contents, digest, line_length=line_length, fast=fast, mode=mode
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # reported once a request asks for the file
+            self.failed.add((key, fast))
+
+
+WATCHES: Dict[IndexKey, Watch] = {}
+
+
+def add_watch(
+    root: Path,
+    include: Pattern[str],
+    exclude: Pattern[str],
+    paths: Iterable[Path],
+    options: Options,
+) -> None:
+    key = (root, include.pattern, exclude.pattern)
+    index = get_index(root, include, exclude)
+    if key not in WATCHES:
+        WATCHES[key] = Watch(index)
+    WATCHES[key].add(paths, options)
+
+
+class Channel:
+    """Output of a single request.
+
+    Consecutive writes to the same stream are batched into a single frame,
+    which is sent on the next iteration of the event loop. Writes from other
+    threads are handed over to the event loop. The requests of a connection
+    share its `writer` and the `lock` serializing waits for it to drain.
+    """
+
+    def __init__(
+        self,
+        writer: asyncio.StreamWriter,
+        request_id: int = 0,
+        lock: Optional[asyncio.Lock] = None,
+    ) -> None:
+        self.writer = writer
+        self.request_id = request_id
+        self.lock = lock or asyncio.Lock()
+        self.kind = Frame.STDOUT
+        self.buffer = bytearray()
+        self.scheduled = False
+        self.loop = asyncio.get_event_loop()
+        self.thread = threading.get_ident()
+
+    def write(self, kind: Frame, data: bytes) -> None:
+        if threading.get_ident() != self.thread:
+            self.loop.call_soon_threadsafe(self.write, kind, data)
+            return
+        if kind is not self.kind:
+            self.flush()
+            self.kind = kind
+        self.buffer.extend(data)
+        if len(self.buffer) >= FLUSH_SIZE:
+            self.flush()
+        elif not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self) -> None:
+        self.scheduled = False
+        if self.buffer:
+            self.writer.write(
+                protocol.pack(self.kind, bytes(self.buffer), self.request_id)
+            )
+            self.buffer.clear()
+
+    def send(self, kind: Frame, payload: bytes = b"") -> None:
+        self.flush()
+        self.writer.write(protocol.pack(kind, payload, self.request_id))
 
-def get_socket_path() -> str:
-    path = os.environ.get("BLACKFAST_SOCKET", DEFAULT_SOCKET_PATH)
-    if len(path) > 100:
-        raise ValueError("Socket path too long")
-    return path
+    async def close(self, num: int) -> None:
+        self.send(Frame.EXIT, protocol.I32.pack(num))
+        async with self.lock:
+            await self.writer.drain()
 
 
-def get_pipe_name() -> str:
-    return os.environ.get("BLACFAST_PIPE_NAME", DEFAULT_PIPE_NAME)
+CHANNEL = ContextVar("CHANNEL")
+PRIORITY = ContextVar("PRIORITY", default=pool.Priority.BULK)
+VERIFY = ContextVar("VERIFY", default="always")
+# set while formatting a whole file whose formatted contents are not needed,
+# to "status" or "diff" if its diff is. Workers then send back a compact result.
+COMPACT = ContextVar("COMPACT", default=None)
+
+
+class Report(black.Report):
+    """black's report, which also sends each outcome to `channel` as a RESULT
+    frame when streaming."""
+
+    def __init__(self, channel: Optional[Channel] = None, **kwargs: bool) -> None:
+        super().__init__(**kwargs)
+        self.channel = channel
+
+    def send(self, src: Path, status: str, **extra: str) -> None:
+        if self.channel is not None:
+            result = {"src": str(src), "status": status, **extra}
+            self.channel.send(Frame.RESULT, json.dumps(result).encode("utf-8"))
+
+    def done(
+        self, src: Path, changed: black.Changed, diff: Optional[str] = None
+    ) -> None:
+        super().done(src, changed)
+        status = "changed" if changed is black.Changed.YES else "unchanged"
+        self.send(src, status, **({} if diff is None else {"diff": diff}))
+
+    def failed(self, src: Path, message: str) -> None:
+        super().failed(src, message)
+        self.send(src, "failed", error=message)
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "changed": self.change_count,
+            "unchanged": self.same_count,
+            "failed": self.failure_count,
+            "exit_code": self.return_code,
+        }
 
 
 @dataclass
 class ClickFile:
-    stream: asyncio.StreamWriter
+    channel: Channel
+    kind: Frame = Frame.STDOUT
 
     def write(self, data: Union[bytes, str]):
         if isinstance(data, str):
             data = data.encode("utf-8")
-        self.stream.write(data)
+        self.channel.write(self.kind, data)
 
     def flush(self):
         pass
 
 
 def context_out(*args, original, **kwargs):
-    original(*args, **kwargs, file=ClickFile(STDOUT.get()))
+    err = kwargs.get("err", getattr(original, "keywords", {}).get("err", False))
+    kind = Frame.STDERR if err else Frame.STDOUT
+    original(*args, **kwargs, file=ClickFile(CHANNEL.get(), kind))
 
 
 def monkeypatch():
@@ -80,40 +434,311 @@ def monkeypatch():
     black.err = partial(context_out, original=black.err)
     black.secho = partial(context_out, original=click.secho)
     black.main = click.option("--work-dir", required=True)(black.main)
+    black.main = click.option(
+        "--watch",
+        is_flag=True,
+        help=(
+            "Don't format anything now. Instead keep checking the given "
+            "directories in the background, so later runs are answered from "
+            "the cache."
+        ),
+    )(black.main)
+    black.main = click.option(
+        "--changed-since",
+        metavar="REV",
+        help=(
+            "Only format files in the given directories which changed since the "
+            "git revision REV, including new files git does not ignore."
+        ),
+    )(black.main)
+    black.main = click.option(
+        "--staged",
+        is_flag=True,
+        help=(
+            "Only format files in the given directories with changes staged for "
+            "commit in git, since HEAD or the --changed-since revision."
+        ),
+    )(black.main)
+    black.main = click.option(
+        "--line-range",
+        "line_ranges",
+        multiple=True,
+        callback=ranges.parse,
+        metavar="START-END",
+        help=(
+            "Only format the top-level statements overlapping these lines of a "
+            "single file, counting from 1. Can be given more than once."
+        ),
+    )(black.main)
+    black.main = click.option(
+        "--priority",
+        type=click.Choice(["interactive", "bulk"]),
+        help=(
+            "Format before bulk requests, or after interactive ones. By default "
+            f"requests for up to {INTERACTIVE_SOURCES} files are interactive."
+        ),
+    )(black.main)
+    black.main = click.option(
+        "--verify",
+        type=click.Choice(["always", "cached", "deferred"]),
+        default="always",
+        help=(
+            "When to check that formatted code is equivalent and stable, unless "
+            "--fast is given. cached: only once for the same source and result. "
+            "deferred: like cached, but write files right away and check them "
+            "in the background, undoing changes which fail the check."
+        ),
+    )(black.main)
+    black.main = click.option(
+        "--supersede",
+        metavar="KEY",
+        help=(
+            "Cancel earlier requests with the same KEY which are still in "
+            "progress, for example the path of an editor buffer formatted on "
+            f"every change. Those exit with {SUPERSEDED}."
+        ),
+    )(black.main)
+    black.main = click.option(
+        "--stream",
+        is_flag=True,
+        help=(
+            "Send the outcome of each file as a JSON document as soon as it is "
+            "known, followed by a JSON summary."
+        ),
+    )(black.main)
+    black.main = click.option(
+        "--stats",
+        type=click.Choice(["text", "json"]),
+        help="Don't format anything, show what the server did since it started.",
+    )(black.main)
     for param in black.main.params:
         if param.name == "src":
             param.type.exists = False
+        elif param.name == "config":
+            param.callback = read_config
 
 
-async def server() -> None:
-    await ipcserver.run(get_socket_path(), get_pipe_name(), connected)
+T = TypeVar("T")
 
 
-async def send_return_code(writer: asyncio.StreamWriter, num: int) -> None:
-    writer.write(b"\x00")
-    writer.write(struct.pack("<i", num))
-    writer.write(b"\n")
-    await writer.drain()
-    writer.close()
+def take(iterator: Iterator[T], count: int) -> List[T]:
+    return list(itertools.islice(iterator, count))
+
+
+def run_in_thread(func: Callable[..., T], *args: Any) -> Awaitable[T]:
+    """Run blocking `func` in the default thread pool, within the current context
+    so its output still reaches the client."""
+    return asyncio.get_event_loop().run_in_executor(
+        None, partial(copy_context().run, func, *args)
+    )
+
+
+async def start() -> None:
+    """Get ready to serve requests. Clients connecting meanwhile wait for this,
+    but not for all workers to start: the first request waits for the first."""
+    monkeypatch()
+    asyncio.ensure_future(log_workers_ready(PROCESS_POOL.start()))
+    await run_in_thread(CACHE.load, get_cache_file())
+    asyncio.ensure_future(flush_cache(get_cache_flush_interval()))
+    asyncio.ensure_future(shrink_idle_pool())
+
+
+async def log_workers_ready(futures: List[Future]) -> None:
+    await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+    logging.info(f"Workers ready: {len(futures)}")
+
+
+def stop() -> None:
+    cache.dump(CACHE.snapshot(), get_cache_file())
+
+
+async def flush_cache(interval: float) -> None:
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        if CACHE.dirty:
+            await loop.run_in_executor(
+                None, cache.dump, CACHE.snapshot(), get_cache_file()
+            )
+
+
+async def shrink_idle_pool() -> None:
+    while True:
+        await asyncio.sleep(IDLE_CHECK_INTERVAL)
+        PROCESS_POOL.shrink_if_idle()
+
+
+def black_stamp() -> Optional[int]:
+    """Changes whenever black is installed again, as when it is upgraded."""
+    try:
+        return os.stat(black.__file__).st_mtime_ns
+    except OSError:
+        return None
+
+
+# of the black this server runs
+BLACK_STAMP = black_stamp()
+# whether the server stops since black changed
+OUTDATED = False
 
 
 async def connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-    STDOUT.set(writer)
+    """Serve requests until the client closes the connection. Requests are
+    handled concurrently and each is answered as soon as it is done."""
+    lock = asyncio.Lock()
+    pending: Dict[int, bytes] = {}
+    tasks: Set["asyncio.Future[None]"] = set()
+    METRICS.counters["connections"] += 1
     try:
-        args = json.loads(await reader.readline())
-    except asyncio.IncompleteReadError:
-        return writer.close()
+        await protocol.handshake(reader, writer)
+        if OUTDATED or black_stamp() != BLACK_STAMP:
+            stop_outdated()
+            raise protocol.ProtocolError(
+                f"black changed since the server started with version "
+                f"{black.__version__}, it restarts now, please try again"
+            )
+        while True:
+            request_id, args, stdin = await protocol.read_request(reader, pending)
+            if tasks:
+                METRICS.counters["pipelined_requests"] += 1
+            task = asyncio.ensure_future(
+                handle(Channel(writer, request_id, lock), args, stdin)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        # clients only close the connection once they got all answers, or
+        # when they give up on them
+        for task in tasks:
+            task.cancel()
+    except protocol.ProtocolError as exc:
+        writer.write(protocol.pack(Frame.ERROR, str(exc).encode("utf-8")))
+    if tasks:
+        await asyncio.wait(tasks)
     try:
-        ctx = black.main.make_context("blackfast", args)
-    except click.ClickException as exc:
-        writer.write(f"{exc.format_message()}\n".encode("utf-8"))
-        return await send_return_code(writer, -1)
+        async with lock:
+            await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+def stop_outdated() -> None:
+    """Stop like `blackfast-server stop` does, so the next request starts a
+    server running the black installed now."""
+    global OUTDATED
+    if not OUTDATED:
+        OUTDATED = True
+        asyncio.get_event_loop().call_soon(os.kill, os.getpid(), signal.SIGINT)
+
+
+async def handle(channel: Channel, args: List[str], stdin: Optional[bytes]) -> None:
+    CHANNEL.set(channel)
+    with METRICS.request():
+        try:
+            with METRICS.phase("root"):
+                project = await run_in_thread(get_project, args)
+            with METRICS.phase("parse"):
+                ctx = black.main.make_context(
+                    "blackfast",
+                    args,
+                    obj=project,
+                    default_map=project and dict(project.defaults),
+                )
+        except click.ClickException as exc:
+            channel.write(Frame.STDERR, f"{exc.format_message()}\n".encode("utf-8"))
+            ctx = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # like an unreadable directory above the work dir
+            METRICS.counters["internal_errors"] += 1
+            channel.write(Frame.STDERR, f"INTERNAL ERROR: {e}\n".encode("utf-8"))
+            ctx = None
+        if ctx is None:
+            return_code = -1
+        elif ctx.params["stats"]:
+            channel.write(Frame.STDOUT, stats(ctx.params["stats"]).encode("utf-8"))
+            return_code = 0
+        else:
+            del ctx.params["stats"]
+            key = ctx.params.pop("supersede")
+            try:
+                return_code = await latest(
+                    key, api(**ctx.params, stdin=stdin, project=project)
+                )
+            except asyncio.CancelledError:
+                METRICS.counters["cancelled_requests"] += 1
+                raise
+            except Exception as e:
+                METRICS.counters["internal_errors"] += 1
+                channel.write(Frame.STDERR, f"INTERNAL ERROR: {e}\n".encode("utf-8"))
+                return_code = -1
+        with METRICS.phase("output"):
+            try:
+                await channel.close(return_code)
+            except ConnectionError:
+                # the client is gone, the connection is closed once all its
+                # requests are done
+                pass
+
+
+LATEST: Dict[str, "asyncio.Future[int]"] = {}
+
+
+async def latest(key: Optional[str], work: Awaitable[int]) -> int:
+    """Run `work`, cancelling the work of an earlier request with the same `key`
+    if it is still in progress."""
+    if key is None:
+        return await work
+    previous = LATEST.get(key)
+    if previous is not None:
+        previous.cancel()
+    task = LATEST[key] = asyncio.ensure_future(work)
     try:
-        return_code = await api(**ctx.params)
-    except Exception as e:
-        writer.write(f"INTERNAL ERROR: {e}\n".encode("utf-8"))
-        return await send_return_code(writer, -1)
-    return await send_return_code(writer, return_code)
+        return await task
+    except asyncio.CancelledError:
+        if LATEST.get(key) is task:
+            # cancelled for another reason
+            raise
+        METRICS.counters["superseded_requests"] += 1
+        black.err("Superseded by a later request.")
+        return SUPERSEDED
+    finally:
+        if LATEST.get(key) is task:
+            del LATEST[key]
+
+
+def get_project(args: List[str]) -> Optional[Project]:
+    """Return the project of the work dir given in `args`, if any."""
+    for i, arg in enumerate(args):
+        if arg == "--work-dir" and i + 1 < len(args):
+            return PROJECTS.get(Path(args[i + 1]))
+        if arg.startswith("--work-dir="):
+            return PROJECTS.get(Path(arg[len("--work-dir=") :]))
+    # click reports it missing
+    return None
+
+
+def read_config(
+    ctx: click.Context, param: click.Parameter, value: Optional[str]
+) -> Optional[str]:
+    if value:
+        return black.read_pyproject_toml(ctx, param, value)
+    # already read along with the project
+    return ctx.obj and ctx.obj.config_file
+
+
+def stats(output: str) -> str:
+    data = METRICS.as_dict(
+        cache={"entries": len(CACHE), "size": CACHE.size, "max_size": CACHE.max_size},
+        store={"entries": len(STORE), "path": str(STORE.path)},
+        workers=PROCESS_POOL.as_dict(),
+        scheduler=SCHEDULER.as_dict(),
+    )
+    if output == "json":
+        return json.dumps(data, indent=2) + "\n"
+    return metrics.format_text(data)
 
 
 async def api(
@@ -132,141 +757,730 @@ async def api(
     include: str = black.DEFAULT_INCLUDES,
     exclude: str = black.DEFAULT_EXCLUDES,
     config: Optional[str] = None,
+    watch: bool = False,
+    stream: bool = False,
+    line_ranges: Tuple[ranges.LineRange, ...] = (),
+    changed_since: Optional[str] = None,
+    staged: bool = False,
+    priority: Optional[str] = None,
+    verify: str = "always",
+    stdin: Optional[bytes] = None,
+    project: Optional[Project] = None,
 ) -> int:
-    """The uncompromising code formatter."""
+    """The uncompromising code formatter.
+
+    `stdin` holds the source to format if `src` contains "-". `project` is the
+    project of `work_dir`.
+    """
     src = tuple(src)
     work_dir = Path(work_dir)
-    loop = asyncio.get_event_loop()
     write_back = black.WriteBack.from_configuration(check=check, diff=diff)
     mode = black.FileMode.from_configuration(
         py36=py36, pyi=pyi, skip_string_normalization=skip_string_normalization
     )
     if config and verbose:
         black.out(f"Using configuration from {config}.", bold=False, fg="blue")
+    if project is None:
+        project = await run_in_thread(PROJECTS.get, work_dir)
     try:
-        include_regex = black.re_compile_maybe_verbose(include)
+        include_regex = project.compile(include)
     except re.error:
         black.err(f"Invalid regular expression for include given: {include!r}")
         return 2
     try:
-        exclude_regex = black.re_compile_maybe_verbose(exclude)
+        exclude_regex = project.compile(exclude)
     except re.error:
         black.err(f"Invalid regular expression for exclude given: {exclude!r}")
         return 2
-    report = black.Report(check=check, quiet=quiet, verbose=verbose)
-    root = black.find_project_root((work_dir,))
-    sources: Set[Path] = set()
+    report = Report(
+        check=check,
+        quiet=quiet,
+        verbose=verbose,
+        channel=CHANNEL.get() if stream else None,
+    )
+    root = project.root
+    if watch:
+        return watch_sources(
+            src, work_dir, root, include_regex, exclude_regex, (line_length, fast, mode)
+        )
+    with lease_index(root, include_regex, exclude_regex) as index:
+        sources = collect_sources(src, work_dir, index, report, changed_since, staged)
+        try:
+            with METRICS.phase("discovery"):
+                # enough to tell whether the request is interactive
+                batch = await run_in_thread(take, sources, INTERACTIVE_SOURCES + 1)
+            if len(batch) == 0:
+                if verbose or not quiet:
+                    black.out("No paths given. Nothing to do 😴")
+                return 0
+            if line_ranges and len(batch) > 1:
+                black.err("--line-range can only be used with a single file")
+                return 2
+            if priority is None:
+                priority = (
+                    "interactive" if len(batch) <= INTERACTIVE_SOURCES else "bulk"
+                )
+            PRIORITY.set(pool.Priority[priority.upper()])
+            VERIFY.set(verify)
+            METRICS.counters[f"{priority}_requests"] += 1
+
+            with METRICS.phase("format"):
+                await format_sources(
+                    batch,
+                    sources,
+                    index,
+                    line_length=line_length,
+                    fast=fast,
+                    write_back=write_back,
+                    mode=mode,
+                    line_ranges=line_ranges,
+                    stdin=stdin,
+                    report=report,
+                )
+        except git.GitError as exc:
+            black.err(f"git: {exc}")
+            return 2
+    METRICS.counters["files_changed"] += report.change_count
+    METRICS.counters["files_unchanged"] += report.same_count
+    METRICS.counters["files_failed"] += report.failure_count
+    if stream:
+        report.channel.send(Frame.SUMMARY, json.dumps(report.summary()).encode("utf-8"))
+    if verbose or not quiet:
+        bang = "💥 💔 💥" if report.return_code else "✨ 🍰 ✨"
+        black.out(f"All done! {bang}")
+        black.secho(str(report), err=True)
+    return report.return_code
+
+
+def watch_sources(
+    src: Tuple[str, ...],
+    work_dir: Path,
+    root: Path,
+    include: Pattern[str],
+    exclude: Pattern[str],
+    options: Options,
+) -> int:
+    paths = []
     for s in src:
         p = work_dir / Path(s)
         if p.is_dir():
-            sources.update(
-                black.gen_python_files_in_dir(
-                    p, root, include_regex, exclude_regex, report
-                )
-            )
-        elif p.is_file() or s == "-":
+            paths.append(p)
+        else:
+            black.err(f"not a directory: {s}")
+            return 1
+    add_watch(root, include, exclude, paths, options)
+    black.out(f"Watching {', '.join(src)} for changes.")
+    return 0
+
+
+def collect_sources(
+    src: Tuple[str, ...],
+    work_dir: Path,
+    index: discovery.Index,
+    report: black.Report,
+    changed_since: Optional[str] = None,
+    staged: bool = False,
+) -> Iterator[Path]:
+    """Yield the files to format as they are found, each once. With
+    `changed_since` or `staged` git tells which files of the given directories
+    changed, instead of walking them."""
+    seen: Set[Path] = set()
+    for s in src:
+        p = work_dir / Path(s)
+        if p.is_dir() and (changed_since or staged):
+            changed = git.changed_files(p, changed_since, staged)
+            found: Iterable[Path] = index.select(p, changed, report)
+        elif p.is_dir():
+            found = index.walk(p, report)
+        elif s == "-":
+            found = [Path(s)]
+        elif p.is_file():
             # if a file was explicitly given, we don't care about its extension
-            sources.add(p)
+            found = [p]
         else:
             black.err(f"invalid path: {s}")
-    if len(sources) == 0:
-        if verbose or not quiet:
-            black.out("No paths given. Nothing to do 😴")
-        return 0
-
-    if len(sources) == 1:
-        black.reformat_one(
-            src=sources.pop(),
+            continue
+        for path in found:
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+
+async def format_sources(
+    batch: List[Path],
+    sources: Iterator[Path],
+    index: discovery.Index,
+    *,
+    line_length: int,
+    fast: bool,
+    write_back: black.WriteBack,
+    mode: black.FileMode,
+    line_ranges: Tuple[ranges.LineRange, ...],
+    stdin: Optional[bytes],
+    report: black.Report,
+) -> None:
+    """Format the files of `batch`, then those `sources` go on to find. At most
+    MAX_IN_PROGRESS files are read and formatted at a time, finding more waits
+    until some of them are done. Each batch goes biggest file first, the
+    scheduler only orders the tasks waiting at a time."""
+    slots = asyncio.Semaphore(MAX_IN_PROGRESS)
+    tasks: Set["asyncio.Future[None]"] = set()
+    try:
+        while batch:
+            batch = await run_in_thread(biggest_first, batch)
+            known_digests = await run_in_thread(index.known_digests, batch)
+            for src in batch:
+                await slots.acquire()
+                if str(src) == "-":
+                    work = reformat_stdin(
+                        stdin or b"",
+                        line_length=line_length,
+                        fast=fast,
+                        write_back=write_back,
+                        mode=mode,
+                        line_ranges=line_ranges,
+                        report=report,
+                    )
+                else:
+                    work = reformat(
+                        src,
+                        index,
+                        known_digests.get(src),
+                        line_length=line_length,
+                        fast=fast,
+                        write_back=write_back,
+                        mode=mode,
+                        line_ranges=line_ranges,
+                        report=report,
+                    )
+                task = asyncio.ensure_future(work)
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+            batch = await run_in_thread(take, sources, BATCH_SIZE)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def biggest_first(batch: List[Path]) -> List[Path]:
+    def size(src: Path) -> int:
+        try:
+            return discovery.get_stat(src)[1]
+        except OSError:
+            # stdin, or gone already
+            return 0
+
+    return sorted(batch, key=size, reverse=True)
+
+
+def read_source(src: Path, index: discovery.Index) -> Tuple[datetime, bytes, bytes]:
+    stat = discovery.get_stat(src)
+    contents = src.read_bytes()
+    digest = cache.digest(contents)
+    index.record(src, stat, digest)
+    return datetime.utcfromtimestamp(stat[0] / 1e9), contents, digest
+
+
+def write_source(src: Path, index: discovery.Index, contents: bytes) -> None:
+    src.write_bytes(contents)
+    index.record(src, discovery.get_stat(src), cache.digest(contents))
+
+
+class PathLocks:
+    """A lock per path, dropped once nobody holds or waits for it."""
+
+    def __init__(self) -> None:
+        self.locks: Dict[Path, Tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def hold(self, path: Path) -> AsyncIterator[None]:
+        path = Path(os.path.normpath(path))
+        lock, users = self.locks.get(path, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        elif lock.locked():
+            METRICS.counters["coalesced"] += 1
+            logging.info(f"Waiting for the request already formatting {path}")
+        self.locks[path] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.locks[path]
+            if users == 1:
+                del self.locks[path]
+            else:
+                self.locks[path] = (lock, users - 1)
+
+
+PATH_LOCKS = PathLocks()
+# formatting in progress by cache key, fast and compact
+IN_FLIGHT: Dict[
+    Tuple[cache.Key, bool, Optional[str]], "asyncio.Future[cache.Entry]"
+] = {}
+# the results of which compact settings serve each of them
+SERVED_BY = {None: (None,), "diff": (None, "diff"), "status": (None, "diff", "status")}
+# how many requests wait for each of them
+WAITERS: Counter = Counter()
+
+
+async def format_cached(
+    contents: bytes,
+    digest: bytes,
+    *,
+    line_length: int,
+    fast: bool,
+    mode: black.FileMode,
+) -> Tuple[cache.Entry, bool]:
+    """Format `contents`, reusing results for contents that were seen before or
+    are being formatted for another request right now.
+
+    Return the cache entry and whether it was a cache hit. Only the digest of
+    the formatted contents might be known where COMPACT is set.
+    """
+    compact = COMPACT.get()
+    if not fast and VERIFY.get() != "always":
+        # checking the result separately needs it
+        compact = None
+    key = cache.make_key(digest, line_length, mode)
+    entry = lookup(key, fast)
+    if entry is not None and serves(entry, compact):
+        METRICS.counters["cache_hits"] += 1
+        return entry, True
+    # verified results are good enough for fast requests too
+    for pending_key in itertools.product([key], (False, fast), SERVED_BY[compact]):
+        pending = IN_FLIGHT.get(pending_key)
+        if pending is not None:
+            METRICS.counters["coalesced"] += 1
+            logging.info(f"Joining formatting in progress for {digest.hex()}")
+            return await wait_shared(pending), True
+    METRICS.counters["cache_misses"] += 1
+    pending = asyncio.ensure_future(
+        format_uncached(
+            contents,
+            key,
             line_length=line_length,
             fast=fast,
-            write_back=write_back,
             mode=mode,
-            report=report,
+            compact=compact,
         )
-    else:
-        await black.schedule_formatting(
-            sources=sources,
-            line_length=line_length,
-            fast=fast,
-            write_back=write_back,
-            mode=mode,
-            report=report,
-            executor=PROCESS_POOL,
-            loop=loop,
+    )
+    IN_FLIGHT[key, fast, compact] = pending
+    pending.add_done_callback(lambda _: IN_FLIGHT.pop((key, fast, compact)))
+    return await wait_shared(pending), False
+
+
+def serves(entry: cache.Entry, compact: Optional[str]) -> bool:
+    """Whether `entry` has all formatting with `compact` set needs."""
+    if entry.unchanged or entry.formatted is not None:
+        return True
+    return compact == "status" or (compact == "diff" and entry.diff is not None)
+
+
+async def wait_shared(pending: "asyncio.Future[cache.Entry]") -> cache.Entry:
+    """Wait for formatting in progress, which other requests might wait for too.
+    It is only cancelled once all of them were cancelled."""
+    WAITERS[pending] += 1
+    try:
+        return await asyncio.shield(pending)
+    finally:
+        WAITERS[pending] -= 1
+        if not WAITERS[pending]:
+            del WAITERS[pending]
+            if not pending.done():
+                METRICS.counters["cancelled_formats"] += 1
+                pending.cancel()
+
+
+async def format_uncached(
+    contents: bytes,
+    key: cache.Key,
+    *,
+    line_length: int,
+    fast: bool,
+    mode: black.FileMode,
+    compact: Optional[str] = None,
+) -> cache.Entry:
+    always = VERIFY.get() == "always"
+    with METRICS.pool.task():
+        try:
+            if compact is not None:
+                result = await SCHEDULER.run(
+                    len(contents),
+                    format_compact,
+                    contents,
+                    line_length,
+                    fast,
+                    mode,
+                    compact == "diff",
+                    priority=PRIORITY.get(),
+                )
+            else:
+                formatted = await SCHEDULER.run(
+                    len(contents),
+                    format_bytes,
+                    contents,
+                    line_length,
+                    fast or not always,
+                    mode,
+                    priority=PRIORITY.get(),
+                )
+        except pool.TaskTimeout:
+            METRICS.counters["timeouts"] += 1
+            raise
+    if compact is not None:
+        METRICS.formatting.observe(result.seconds)
+        entry = cache.Entry(None, not fast, result.digest, result.diff)
+        if result.digest is not None and not fast:
+            remember_verified(cache.pair_key(key, result.digest))
+        return cache_result(key, entry, line_length=line_length, mode=mode)
+    if formatted is not None and not fast:
+        if always:
+            remember_verified(cache.pair_key(key, cache.digest(formatted)))
+        else:
+            await verify(contents, formatted, key, line_length=line_length, mode=mode)
+    entry = cache.Entry(formatted, not fast)
+    return cache_result(key, entry, line_length=line_length, mode=mode)
+
+
+def cache_result(
+    key: cache.Key, entry: cache.Entry, *, line_length: int, mode: black.FileMode
+) -> cache.Entry:
+    CACHE.put(key, entry)
+    if entry.unchanged and entry.verified:
+        remember_verified(key)
+    elif entry.verified:
+        # the stability check proved the output formats to itself
+        digest = entry.digest or cache.digest(entry.formatted or b"")
+        verified_key = cache.make_key(digest, line_length, mode)
+        CACHE.put(verified_key, cache.Entry(None, verified=True))
+        remember_verified(verified_key)
+    return entry
+
+
+async def verify(
+    contents: bytes,
+    formatted: bytes,
+    key: cache.Key,
+    *,
+    line_length: int,
+    mode: black.FileMode,
+    priority: Optional[pool.Priority] = None,
+) -> None:
+    """Check that `formatted` is a safe replacement of `contents`, like black
+    does without --fast, unless the store knows it was checked before. Raise
+    AssertionError if it is not."""
+    pair = cache.pair_key(key, cache.digest(formatted))
+    if is_stored(pair):
+        METRICS.counters["verifications_skipped"] += 1
+        return
+    with METRICS.pool.task():
+        await SCHEDULER.run(
+            len(contents),
+            verify_bytes,
+            contents,
+            formatted,
+            line_length,
+            mode,
+            priority=priority or PRIORITY.get(),
         )
-    if verbose or not quiet:
-        bang = "💥 💔 💥" if report.return_code else "✨ 🍰 ✨"
-        black.out(f"All done! {bang}")
-        black.secho(str(report), err=True)
-    return report.return_code
+    METRICS.counters["verifications"] += 1
+    remember_verified(pair)
 
 
-if sys.platform == "win32":
+# keys of sources whose deferred check failed, they are checked right away
+UNSAFE: Set[cache.Key] = set()
+BACKGROUND: Set["asyncio.Future[None]"] = set()
 
-    from asyncio.windows_events import CONNECT_PIPE_INIT_DELAY, CONNECT_PIPE_MAX_DELAY
-    import _overlapped
-    import _winapi
 
-    def wait_connectable(timeout: Union[int, float]) -> None:
-        end = time.monotonic() + timeout
-        delay = CONNECT_PIPE_INIT_DELAY
-        address = get_pipe_name()
-        while time.monotonic() > end:
-            try:
-                handle = _overlapped.ConnectPipe(address)
-                _winapi.CloseHandle(handle)
-                return
-            except OSError as exc:
-                if exc.winerror != _overlapped.ERROR_PIPE_BUSY:
-                    raise
+def verify_later(
+    src: Path,
+    index: discovery.Index,
+    contents: bytes,
+    digest: bytes,
+    formatted: bytes,
+    *,
+    line_length: int,
+    mode: black.FileMode,
+) -> None:
+    """Check the `formatted` version of `contents` just written to `src` in the
+    background, and write back `contents` if it fails."""
 
-            # ConnectPipe() failed with ERROR_PIPE_BUSY: retry later
-            delay = min(delay * 2, CONNECT_PIPE_MAX_DELAY)
-            time.sleep(delay)
-        raise Exception("Server did not start")
+    async def check() -> None:
+        key = cache.make_key(digest, line_length, mode)
+        entry = lookup(key, fast=False)
+        if entry is not None and entry.formatted == formatted:
+            return
+        try:
+            await verify(
+                contents,
+                formatted,
+                key,
+                line_length=line_length,
+                mode=mode,
+                priority=pool.Priority.BULK,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            METRICS.counters["verification_failures"] += 1
+            CACHE.discard(key)
+            UNSAFE.add(key)
+            async with PATH_LOCKS.hold(src):
+                undone = await run_in_thread(
+                    undo_write, src, index, contents, formatted
+                )
+            logging.error(
+                f"Formatting {src} failed the check{', undone' if undone else ''}: "
+                f"{exc}"
+            )
+            return
+        entry = cache.Entry(formatted, verified=True)
+        cache_result(key, entry, line_length=line_length, mode=mode)
 
+    task = asyncio.ensure_future(check())
+    BACKGROUND.add(task)
+    task.add_done_callback(BACKGROUND.discard)
 
-else:
 
-    def wait_connectable(timeout: Union[int, float]) -> None:
-        end = time.monotonic() + timeout
-        while end > time.monotonic():
-            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            try:
-                sock.connect(get_socket_path())
-                sock.close()
-                return
-            except:
-                pass
-        raise Exception("Server did not start")
+def undo_write(
+    src: Path, index: discovery.Index, contents: bytes, formatted: bytes
+) -> bool:
+    """Write `contents` back to `src`, unless it changed since `formatted` was
+    written. Return whether it was written."""
+    try:
+        if src.read_bytes() != formatted:
+            return False
+    except OSError:
+        return False
+    write_source(src, index, contents)
+    return True
 
 
-def run():
-    monkeypatch()
-    asyncio.run(server())
+async def make_diff(
+    src: bytes, entry: cache.Entry, src_name: str, dst_name: str
+) -> str:
+    """`black.diff` of `src` and its formatted version in `entry`. Compact
+    results of workers come with the hunks, others are diffed in a thread rather
+    than sending the contents to a worker and back again."""
+    hunks = entry.diff
+    if hunks is None:
+        hunks = await run_in_thread(diff_hunks, src, entry.formatted)
+    return f"--- {src_name}\n+++ {dst_name}\t{datetime.utcnow()} +0000\n{hunks}"
 
 
-@click.group()
-def cli() -> None:
-    pass
+def lookup(key: cache.Key, fast: bool) -> Optional[cache.Entry]:
+    """Return the cached result for `key`, which might also come from the store
+    of sources verified to be well formatted."""
+    entry = CACHE.get(key, fast=fast)
+    if entry is not None:
+        return entry
+    if not is_stored(key):
+        return None
+    METRICS.counters["store_hits"] += 1
+    entry = cache.Entry(None, verified=True)
+    CACHE.put(key, entry)
+    return entry
 
 
-@cli.command("start")
-def start() -> None:
+def is_stored(key: cache.Key) -> bool:
     try:
-        demon.spawn(get_pid_file(), run)
-    except demon.PidExists:
-        pass
-    wait_connectable(10)
+        return key in STORE
+    except (OSError, store.StoreError) as exc:
+        logging.warning(f"Reading {STORE.path} failed: {exc}")
+        return False
 
 
-@cli.command("stop")
-def stop() -> None:
+def remember_verified(key: cache.Key) -> None:
     try:
-        demon.kill(get_pid_file())
-    except demon.PidDoesNotExist:
-        pass
+        STORE.add(key)
+    except (OSError, store.StoreError) as exc:
+        logging.warning(f"Writing {STORE.path} failed: {exc}")
+
+
+async def format_selected(
+    contents: bytes,
+    digest: bytes,
+    line_ranges: Tuple[ranges.LineRange, ...],
+    *,
+    line_length: int,
+    fast: bool,
+    mode: black.FileMode,
+) -> Tuple[cache.Entry, bool]:
+    """Format `contents`, or only the top-level statements overlapping
+    `line_ranges` if there are any. Each statement goes through the format cache
+    on its own, so after an edit only the statements that changed are formatted
+    again.
+
+    Return the result, like the cache entry of the whole contents, and whether
+    it was a cache hit.
+    """
+    if not line_ranges:
+        return await format_cached(
+            contents, digest, line_length=line_length, fast=fast, mode=mode
+        )
+    source, encoding, newline = black.decode_bytes(contents)
+    lines = io.StringIO(source).readlines()
+    spans = await run_in_thread(ranges.statements, source, line_ranges)
+    blocks = ["".join(lines[start:end]).encode("utf-8") for start, end in spans]
+    results = await asyncio.gather(
+        *(
+            format_cached(
+                block,
+                cache.digest(block),
+                line_length=line_length,
+                fast=fast,
+                mode=mode,
+            )
+            for block in blocks
+        )
+    )
+    changed = False
+    # from the end, so the spans before stay valid
+    for (start, end), (entry, _) in reversed(list(zip(spans, results))):
+        if entry.formatted is not None:
+            lines[start:end] = [entry.formatted.decode("utf-8")]
+            changed = True
+    hit = all(hit for _, hit in results)
+    if not changed:
+        return cache.Entry(None, verified=not fast), hit
+    formatted = "".join(lines).replace("\n", newline).encode(encoding)
+    return cache.Entry(formatted, verified=not fast), hit
+
 
+async def reformat(
+    src: Path,
+    index: discovery.Index,
+    digest: Optional[bytes],
+    *,
+    line_length: int,
+    fast: bool,
+    write_back: black.WriteBack,
+    mode: black.FileMode,
+    line_ranges: Tuple[ranges.LineRange, ...] = (),
+    report: Report,
+) -> None:
+    """Reformat `src`. Unlike black this never reads or writes black's on-disk
+    cache.
 
-if __name__ == "__main__":
-    cli()
+    `digest` is the digest of the contents of `src` if they are known, files
+    already known to be well formatted are not read at all. With `line_ranges`
+    only the top-level statements overlapping them are formatted.
+    """
+    if src.suffix == ".pyi":
+        mode |= black.FileMode.PYI
+    if digest is not None:
+        entry = lookup(cache.make_key(digest, line_length, mode), fast)
+        if entry is not None and entry.unchanged:
+            METRICS.counters["cache_hits"] += 1
+            report.done(src, black.Changed.CACHED)
+            return
+    try:
+        # requests racing for the same file take turns, the later ones find
+        # the result of the earlier ones in the cache
+        async with PATH_LOCKS.hold(src):
+            then, contents, digest = await run_in_thread(read_source, src, index)
+            if write_back != black.WriteBack.YES and not line_ranges:
+                COMPACT.set("diff" if write_back == black.WriteBack.DIFF else "status")
+            # checking parts of a file would fail the stability check
+            defer = (
+                VERIFY.get() == "deferred"
+                and write_back == black.WriteBack.YES
+                and not fast
+                and not line_ranges
+                and cache.make_key(digest, line_length, mode) not in UNSAFE
+            )
+            entry, hit = await format_selected(
+                contents,
+                digest,
+                line_ranges,
+                line_length=line_length,
+                fast=fast or defer,
+                mode=mode,
+            )
+            diff = None
+            if entry.unchanged:
+                changed = black.Changed.CACHED if hit else black.Changed.NO
+            else:
+                changed = black.Changed.YES
+                formatted = entry.formatted
+                if write_back == black.WriteBack.YES and formatted is not None:
+                    await run_in_thread(write_source, src, index, formatted)
+                    if defer:
+                        verify_later(
+                            src,
+                            index,
+                            contents,
+                            digest,
+                            formatted,
+                            line_length=line_length,
+                            mode=mode,
+                        )
+                elif write_back == black.WriteBack.DIFF:
+                    diff = await make_diff(
+                        contents, entry, f"{src}\t{then} +0000", str(src)
+                    )
+                    if report.channel is None:
+                        ClickFile(CHANNEL.get()).write(diff)
+                        diff = None
+        report.done(src, changed, diff)
+    except asyncio.CancelledError:
+        # a subclass of Exception before Python 3.8
+        raise
+    except Exception as exc:
+        report.failed(src, str(exc))
+
+
+async def reformat_stdin(
+    contents: bytes,
+    *,
+    line_length: int,
+    fast: bool,
+    write_back: black.WriteBack,
+    mode: black.FileMode,
+    line_ranges: Tuple[ranges.LineRange, ...] = (),
+    report: Report,
+) -> None:
+    """Reformat source sent by the client. The result is sent back on the socket,
+    nothing touches the disk."""
+    src = Path("-")
+    channel = CHANNEL.get()
+    try:
+        then = datetime.utcnow()
+        if write_back != black.WriteBack.YES and not line_ranges:
+            COMPACT.set("diff" if write_back == black.WriteBack.DIFF else "status")
+        entry, _ = await format_selected(
+            contents,
+            cache.digest(contents),
+            line_ranges,
+            line_length=line_length,
+            fast=fast,
+            mode=mode,
+        )
+        if entry.unchanged:
+            if write_back == black.WriteBack.YES:
+                channel.send(Frame.UNCHANGED)
+            report.done(src, black.Changed.NO)
+            return
+        diff = None
+        if write_back == black.WriteBack.YES and entry.formatted is not None:
+            channel.send(Frame.FORMATTED, entry.formatted)
+        elif write_back == black.WriteBack.DIFF:
+            diff = await make_diff(contents, entry, f"STDIN\t{then} +0000", "STDOUT")
+            if report.channel is None:
+                _, encoding, newline = black.decode_bytes(contents)
+                channel.write(
+                    Frame.STDOUT, diff.replace("\n", newline).encode(encoding)
+                )
+                diff = None
+        report.done(src, black.Changed.YES, diff)
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:
+        # like black, echo the source back if it cannot be formatted
+        if write_back == black.WriteBack.YES:
+            channel.send(Frame.UNCHANGED)
+        report.failed(src, str(exc))
@@ -0,0 +1,203 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import *
+
+MAGIC = b"BFSTORE\0"
+FORMAT_VERSION = 1
+# magic, format version, log2 of the number of slots, number of keys
+HEADER = struct.Struct("<8sIIQ")
+SLOT_SIZE = 32
+EMPTY = bytes(SLOT_SIZE)
+MIN_SLOTS_LOG2 = 10
+# the table grows once more of its slots are taken
+MAX_LOAD = 0.5
+# how often to check whether another process replaced the file, in seconds
+REOPEN_INTERVAL = 1
+
+
+class StoreError(Exception):
+    pass
+
+
+def hash_key(key: Tuple[bytes, int, int, str]) -> bytes:
+    """The 32 byte key a `cache.Key` is stored as."""
+    digest, line_length, mode, version = key
+    return hashlib.sha256(
+        digest + struct.pack("<II", line_length, mode) + version.encode("utf-8")
+    ).digest()
+
+
+def slots_for(count: int) -> int:
+    """log2 of the number of slots `count` keys need."""
+    return max(MIN_SLOTS_LOG2, math.ceil(math.log2(max(count, 1) / MAX_LOAD)))
+
+
+class Table:
+    """An open addressing hash table of 32 byte keys in a memory mapped file.
+
+    The keys are hashes already, the slot of a key is taken from its first
+    bytes. Adding a key only writes its slot and the count in the header, so
+    processes sharing the file see each other's keys right away.
+    """
+
+    def __init__(self, path: Path, writable: bool = True) -> None:
+        self.path = path
+        with path.open("r+b" if writable else "rb") as fobj:
+            self.ino = os.fstat(fobj.fileno()).st_ino
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            try:
+                self.map = mmap.mmap(fobj.fileno(), 0, access=access)
+            except ValueError:
+                raise StoreError(f"{path} is empty")
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise StoreError(f"{path} is not a blackfast store")
+        magic, version, self.slots_log2, _ = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise StoreError(f"{path} is not a blackfast store of this version")
+        self.slots = 1 << self.slots_log2
+        if len(self.map) != HEADER.size + self.slots * SLOT_SIZE:
+            self.close()
+            raise StoreError(f"{path} is truncated")
+
+    @classmethod
+    def create(cls, path: Path, keys: Iterable[bytes], count: int) -> "Table":
+        """Write a table of `count` `keys` to `path`, replacing it atomically."""
+        slots_log2 = slots_for(count)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with tmp.open("wb") as fobj:
+            fobj.write(HEADER.pack(MAGIC, FORMAT_VERSION, slots_log2, 0))
+            fobj.truncate(HEADER.size + (SLOT_SIZE << slots_log2))
+        table = cls(tmp)
+        for key in keys:
+            table.add(key)
+        table.map.flush()
+        os.replace(str(tmp), str(path))
+        table.path = path
+        return table
+
+    @property
+    def count(self) -> int:
+        return HEADER.unpack_from(self.map)[3]
+
+    def probe(self, key: bytes) -> Iterator[int]:
+        slot = int.from_bytes(key[:8], "little") & (self.slots - 1)
+        for _ in range(self.slots):
+            yield HEADER.size + slot * SLOT_SIZE
+            slot = (slot + 1) & (self.slots - 1)
+
+    def __contains__(self, key: bytes) -> bool:
+        for offset in self.probe(key):
+            found = self.map[offset : offset + SLOT_SIZE]
+            if found == key:
+                return True
+            if found == EMPTY:
+                return False
+        return False
+
+    def add(self, key: bytes) -> bool:
+        """Add `key`, return whether it was not there yet."""
+        for offset in self.probe(key):
+            found = self.map[offset : offset + SLOT_SIZE]
+            if found == key:
+                return False
+            if found == EMPTY:
+                self.map[offset : offset + SLOT_SIZE] = key
+                # not atomic, it only has to be about right
+                magic, version, slots_log2, count = HEADER.unpack_from(self.map)
+                HEADER.pack_into(self.map, 0, magic, version, slots_log2, count + 1)
+                return True
+        raise StoreError(f"{self.path} is full")
+
+    def keys(self) -> Iterator[bytes]:
+        for offset in range(HEADER.size, len(self.map), SLOT_SIZE):
+            key = self.map[offset : offset + SLOT_SIZE]
+            if key != EMPTY:
+                yield key
+
+    def close(self) -> None:
+        self.map.close()
+
+
+class Store:
+    """Keys of sources verified to be well formatted, in a file shared by all
+    servers and portable between machines. Unlike the format cache it holds no
+    formatted sources, so it stays small enough to keep every key ever seen."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.table: Optional[Table] = None
+        self.checked = 0.0
+
+    def open(self) -> Table:
+        """The current table, opened again if another process replaced it."""
+        now = time.monotonic()
+        if self.table is not None and now - self.checked < REOPEN_INTERVAL:
+            return self.table
+        self.checked = now
+        try:
+            if self.table is not None and os.stat(self.path).st_ino == self.table.ino:
+                return self.table
+        except FileNotFoundError:
+            pass
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+        try:
+            self.table = Table(self.path)
+        except (FileNotFoundError, StoreError):
+            # missing or unusable, start over
+            self.table = Table.create(self.path, (), 0)
+        return self.table
+
+    def __len__(self) -> int:
+        return self.open().count
+
+    def __contains__(self, key: Tuple[bytes, int, int, str]) -> bool:
+        return hash_key(key) in self.open()
+
+    def add(self, key: Tuple[bytes, int, int, str]) -> None:
+        self.merge([hash_key(key)])
+
+    def merge(self, keys: Iterable[bytes]) -> int:
+        """Add hashed `keys`, return how many were new."""
+        table = self.open()
+        added = 0
+        for key in keys:
+            if table.count + 1 > table.slots * MAX_LOAD:
+                table = self.grow()
+            added += table.add(key)
+        return added
+
+    def grow(self) -> Table:
+        assert self.table is not None
+        keys = list(self.table.keys())
+        self.table.close()
+        self.table = Table.create(self.path, keys, len(keys) * 2)
+        self.checked = time.monotonic()
+        return self.table
+
+    def export(self, path: Path) -> int:
+        """Write a compact copy of the store to `path`, return the number of keys."""
+        keys = list(self.open().keys())
+        Table.create(path, keys, len(keys)).close()
+        return len(keys)
+
+    def load(self, path: Path) -> int:
+        """Add the keys of the store at `path`, return how many were new."""
+        other = Table(path, writable=False)
+        try:
+            return self.merge(other.keys())
+        finally:
+            other.close()
+
+    def close(self) -> None:
+        if self.table is not None:
+            self.table.close()
+            self.table = None
@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+from dataclasses import dataclass
+from typing import *
+
+import black
+
+from .cache import digest
+
+T = TypeVar("T")
+
+
+def format_bytes(
+    src: bytes, line_length: int, fast: bool, mode: black.FileMode
+) -> Optional[bytes]:
+    """Format the raw contents of a file. Return None if nothing changed."""
+    contents, encoding, newline = black.decode_bytes(src)
+    try:
+        dst = black.format_file_contents(
+            contents, line_length=line_length, fast=fast, mode=mode
+        )
+    except black.NothingChanged:
+        return None
+    return dst.replace("\n", newline).encode(encoding)
+
+
+def diff_hunks(src: bytes, dst: bytes) -> str:
+    """The hunks of `black.diff` of the raw contents of a file and its formatted
+    version, without the lines naming the files."""
+    diff = black.diff(black.decode_bytes(src)[0], black.decode_bytes(dst)[0], "", "")
+    return diff.split("\n", 2)[2]
+
+
+@dataclass
+class Result:
+    """What formatting a source amounted to, without the formatted contents."""
+
+    # digest of the formatted contents, None if nothing changed
+    digest: Optional[bytes]
+    # see diff_hunks, if they were asked for and anything changed
+    diff: Optional[str]
+    # spent formatting, in seconds
+    seconds: float
+
+
+def format_compact(
+    src: bytes, line_length: int, fast: bool, mode: black.FileMode, diff: bool
+) -> Result:
+    """Like `format_bytes`, for when the formatted contents are not needed. Only
+    a small result goes back to the server instead."""
+    start = time.perf_counter()
+    dst = format_bytes(src, line_length, fast, mode)
+    seconds = time.perf_counter() - start
+    if dst is None:
+        return Result(None, None, seconds)
+    return Result(digest(dst), diff_hunks(src, dst) if diff else None, seconds)
+
+
+def verify_bytes(
+    src: bytes, dst: bytes, line_length: int, mode: black.FileMode
+) -> None:
+    """Raise AssertionError unless `dst`, formatted from `src`, is equivalent to
+    it and formats to itself, which black checks unless --fast is given."""
+    src_contents = black.decode_bytes(src)[0]
+    dst_contents = black.decode_bytes(dst)[0]
+    black.assert_equivalent(src_contents, dst_contents)
+    black.assert_stable(src_contents, dst_contents, line_length=line_length, mode=mode)
+
+
+def warm_up() -> None:
+    """Load everything formatting needs, so the first request does not have to."""
+    black.format_file_contents(
+        "warm_up = 'up'\n", line_length=black.DEFAULT_LINE_LENGTH, fast=False
+    )
+
+
+def memory() -> int:
+    """Resident memory of this process in bytes, 0 if unknown."""
+    try:
+        with open("/proc/self/statm") as fobj:
+            return int(fobj.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # the peak instead, in kilobytes except on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measured(task: Callable[[], T]) -> Tuple[T, int]:
+    """Run `task`, return its result and the memory this process uses after."""
+    return task(), memory()
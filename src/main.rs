@@ -2,13 +2,12 @@
 extern crate serde_json;
 extern crate appdirs;
 
-use std::io::BufRead;
 use std::io::Write;
-use std::str;
 
 use std::env;
 #[cfg(windows)]
 use std::fs::File;
+use std::io;
 use std::io::BufReader;
 use std::io::Read;
 #[cfg(not(windows))]
@@ -25,47 +24,136 @@ const SERVER_BIN_NAME: &'static str = "blackfast-server.exe";
 #[cfg(not(windows))]
 const SERVER_BIN_NAME: &'static str = "blackfast-server";
 
+// Must match blackfast.protocol.VERSION
+const PROTOCOL_VERSION: u32 = 3;
+// This client sends a single request per connection.
+const REQUEST_ID: u32 = 0;
+
+// Frame types, see blackfast.protocol.Frame
+const HELLO: u8 = 0;
+const ARGS: u8 = 1;
+const STDIN: u8 = 2;
+const STDOUT: u8 = 3;
+const STDERR: u8 = 4;
+const FORMATTED: u8 = 5;
+const UNCHANGED: u8 = 6;
+const EXIT: u8 = 7;
+const ERROR: u8 = 8;
+const RESULT: u8 = 9;
+const SUMMARY: u8 = 10;
+
 #[inline]
-fn get_retcode(a: u8, b: u8, c: u8, d: u8) -> i32 {
+fn get_u32(a: u8, b: u8, c: u8, d: u8) -> u32 {
     let mut number = u32::from(d);
     number = number << 8 | u32::from(c);
     number = number << 8 | u32::from(b);
     number = number << 8 | u32::from(a);
-    number as i32
+    number
+}
+
+#[inline]
+fn get_retcode(a: u8, b: u8, c: u8, d: u8) -> i32 {
+    get_u32(a, b, c, d) as i32
+}
+
+#[inline]
+fn put_u32(number: u32) -> [u8; 4] {
+    [
+        number as u8,
+        (number >> 8) as u8,
+        (number >> 16) as u8,
+        (number >> 24) as u8,
+    ]
+}
+
+fn write_frame<W: Write>(stream: &mut W, kind: u8, payload: &[u8]) -> io::Result<()> {
+    let mut frame: Vec<u8> = Vec::with_capacity(payload.len() + 9);
+    frame.push(kind);
+    frame.extend_from_slice(&put_u32(REQUEST_ID));
+    frame.extend_from_slice(&put_u32(payload.len() as u32));
+    frame.extend_from_slice(payload);
+    stream.write_all(&frame)
+}
+
+fn read_frame<R: Read>(stream: &mut R) -> io::Result<(u8, Vec<u8>)> {
+    let mut header = [0; 9];
+    stream.read_exact(&mut header)?;
+    let mut payload = vec![0; get_u32(header[5], header[6], header[7], header[8]) as usize];
+    stream.read_exact(&mut payload)?;
+    Ok((header[0], payload))
 }
 
 fn user_data_dir(filename: String) -> Result<PathBuf, ()> {
     appdirs::user_data_dir(Some("blackfast"), None, false).map(|p| p.join(filename))
 }
 
-fn get_env_or_user_data_dir(name: &str, ext: &str) -> Result<PathBuf, ()> {
+// Must match blackfast.config.fnv1a
+fn fnv1a(data: &[u8]) -> u64 {
+    let mut number: u64 = 0xcbf29ce484222325;
+    for byte in data {
+        number = (number ^ u64::from(*byte)).wrapping_mul(0x100000001b3);
+    }
+    number
+}
+
+// The server to use is the one installed in the current environment, that is
+// the first one on the PATH.
+fn find_server() -> Option<PathBuf> {
+    env::var_os("PATH").and_then(|paths| {
+        env::split_paths(&paths)
+            .map(|dir| dir.join(SERVER_BIN_NAME))
+            .find(|path| path.is_file())
+            .and_then(|path| path.canonicalize().ok())
+    })
+}
+
+// Must match blackfast.config.get_server_id
+fn get_server_id(server: &Option<PathBuf>) -> String {
+    if let Ok(id) = env::var("BLACKFAST_SERVER_ID") {
+        return id;
+    }
+    let scripts = match server.as_ref().and_then(|path| path.parent()) {
+        Some(scripts) => scripts.to_string_lossy().into_owned(),
+        None => String::new(),
+    };
+    // canonicalize returns extended length paths on windows
+    let scripts = scripts.trim_start_matches("\\\\?\\");
+    format!("{:016x}", fnv1a(scripts.as_bytes()))
+}
+
+fn get_env_or_server_file(name: &str, ext: &str, server_id: &str) -> Result<PathBuf, ()> {
     match env::var(format!("{}_{}", name.to_uppercase(), ext.to_uppercase())) {
         Ok(val) => Ok(PathBuf::from(val)),
-        Err(_) => user_data_dir(format!("{}.{}", name, ext)),
+        Err(_) => user_data_dir(format!("servers/{}.{}", server_id, ext)),
     }
 }
 
 #[cfg(not(windows))]
-fn get_socket() -> Result<PathBuf, ()> {
-    get_env_or_user_data_dir("blackfast", "socket")
+fn get_socket(server_id: &str) -> Result<PathBuf, ()> {
+    get_env_or_server_file("blackfast", "socket", server_id)
 }
 
-fn get_pidfile() -> Result<PathBuf, ()> {
-    get_env_or_user_data_dir("blackfast", "pid")
+fn get_pidfile(server_id: &str) -> Result<PathBuf, ()> {
+    get_env_or_server_file("blackfast", "pid", server_id)
 }
 
 #[cfg(windows)]
-fn get_pipe_name() -> String {
+fn get_pipe_name(server_id: &str) -> String {
     match env::var("BLACKFAST_PIPE_NAME") {
         Ok(name) => name,
-        Err(_) => String::from(DEFAULT_PIPE_NAME),
+        Err(_) => format!("{}-{}", DEFAULT_PIPE_NAME, server_id),
     }
 }
 
-fn maybe_start(p: &PathBuf) {
+fn maybe_start(p: &PathBuf, server: &Option<PathBuf>, server_id: &str) {
     if !p.exists() {
-        Command::new(SERVER_BIN_NAME)
+        let program = match *server {
+            Some(ref path) => path.as_os_str(),
+            None => SERVER_BIN_NAME.as_ref(),
+        };
+        Command::new(program)
             .arg("start")
+            .env("BLACKFAST_SERVER_ID", server_id)
             .spawn()
             .expect("failed to start server")
             .wait()
@@ -74,8 +162,8 @@ fn maybe_start(p: &PathBuf) {
 }
 
 #[cfg(not(windows))]
-fn connect() -> Result<impl Read + Write, ()> {
-    let socket = match get_socket() {
+fn connect(server_id: &str) -> Result<impl Read + Write, ()> {
+    let socket = match get_socket(server_id) {
         Ok(p) => p,
         Err(_) => return Err(()),
     };
@@ -86,31 +174,34 @@ fn connect() -> Result<impl Read + Write, ()> {
 }
 
 #[cfg(windows)]
-fn connect() -> Result<impl Read + Write, ()> {
-    match File::open(get_pipe_name()) {
+fn connect(server_id: &str) -> Result<impl Read + Write, ()> {
+    match File::open(get_pipe_name(server_id)) {
         Ok(f) => Ok(f),
         Err(_) => return Err(()),
     }
 }
 
 fn run() -> Result<(), i32> {
-    let pidfile = match get_pidfile() {
+    let server = find_server();
+    let server_id = get_server_id(&server);
+    let pidfile = match get_pidfile(&server_id) {
         Ok(p) => p,
         Err(_) => return Err(-1),
     };
-    maybe_start(&pidfile);
+    maybe_start(&pidfile, &server, &server_id);
     let mut args: Vec<String> = env::args().skip(1).collect();
+    let uses_stdin = args.iter().any(|arg| arg == "-");
     let mut full_args: Vec<String> = Vec::with_capacity(args.len() + 2);
     full_args.push(String::from("--work-dir"));
     full_args.push(String::from(env::current_dir().unwrap().to_str().unwrap()));
     full_args.append(&mut args);
     let request = json!(full_args);
-    let mut stream = match connect() {
+    let mut stream = match connect(&server_id) {
         Ok(stream) => stream,
         Err(_) => match std::fs::remove_file(&pidfile) {
             Ok(_) => {
-                maybe_start(&pidfile);
-                match connect() {
+                maybe_start(&pidfile, &server, &server_id);
+                match connect(&server_id) {
                     Ok(stream) => stream,
                     Err(_) => return Err(-1),
                 }
@@ -119,21 +210,62 @@ fn run() -> Result<(), i32> {
         },
     };
 
-    stream
-        .write_all(format!("{}\n", request).as_bytes())
-        .unwrap();
+    write_frame(&mut stream, HELLO, &put_u32(PROTOCOL_VERSION)).unwrap();
+    // The source to format is sent along with the request when reading from
+    // stdin, so the server never needs to touch the disk.
+    let source = if uses_stdin {
+        let mut source: Vec<u8> = Vec::new();
+        io::stdin().read_to_end(&mut source).unwrap();
+        write_frame(&mut stream, STDIN, &source).unwrap();
+        Some(source)
+    } else {
+        None
+    };
+    write_frame(&mut stream, ARGS, request.to_string().as_bytes()).unwrap();
     let mut reader = BufReader::new(stream);
-    let mut buf: Vec<u8> = Vec::with_capacity(100);
+    let stdout = io::stdout();
+    let stderr = io::stderr();
     loop {
-        match reader.read_until(b'\n', &mut buf) {
-            Ok(i) if i == 0 => return Err(-1),
-            Ok(_) => match buf.as_slice() {
-                [0, a, b, c, d, b'\n'] => return Err(get_retcode(*a, *b, *c, *d)),
-                slice => print!("{}", str::from_utf8(&slice).unwrap()),
+        let (kind, payload) = match read_frame(&mut reader) {
+            Ok(frame) => frame,
+            Err(err) => {
+                eprintln!("{}", err);
+                return Err(-1);
+            }
+        };
+        match (kind, payload.as_slice()) {
+            (HELLO, &[a, b, c, d]) if get_u32(a, b, c, d) == PROTOCOL_VERSION => {}
+            (HELLO, _) => {
+                eprintln!("blackfast server speaks a different protocol version, restart it with `blackfast-server stop`");
+                return Err(-1);
+            }
+            (STDOUT, payload) | (FORMATTED, payload) => stdout.lock().write_all(payload).unwrap(),
+            (STDERR, payload) => stderr.lock().write_all(payload).unwrap(),
+            // One JSON document per line, flushed right away for tools reading along.
+            (RESULT, payload) | (SUMMARY, payload) => {
+                let mut stdout = stdout.lock();
+                stdout.write_all(payload).unwrap();
+                stdout.write_all(b"\n").unwrap();
+                stdout.flush().unwrap();
+            }
+            (UNCHANGED, _) => match source {
+                Some(ref source) => stdout.lock().write_all(source).unwrap(),
+                None => return Err(-1),
             },
-            Err(err) => eprintln!("{}", err),
+            (EXIT, &[a, b, c, d]) => {
+                stdout.lock().flush().unwrap();
+                return Err(get_retcode(a, b, c, d));
+            }
+            (ERROR, payload) => {
+                stderr.lock().write_all(payload).unwrap();
+                eprintln!();
+                return Err(-1);
+            }
+            (_, _) => {
+                eprintln!("unexpected frame from blackfast server");
+                return Err(-1);
+            }
         }
-        buf.clear();
     }
 }
 
@@ -154,4 +286,19 @@ mod tests {
         assert_eq!(get_retcode(254, 255, 255, 255), -2);
         assert_eq!(get_retcode(10, 0, 0, 0), 10);
     }
+
+    #[test]
+    fn test_fnv1a() {
+        // same as blackfast.config.fnv1a
+        assert_eq!(fnv1a(b""), 0xcbf29ce484222325);
+        assert_eq!(fnv1a(b"/usr/bin"), 0x0c0ca4c92f66ab32);
+    }
+
+    #[test]
+    fn test_put_u32() {
+        assert_eq!(put_u32(10), [10, 0, 0, 0]);
+        assert_eq!(put_u32(258), [2, 1, 0, 0]);
+        let [a, b, c, d] = put_u32(123456789);
+        assert_eq!(get_u32(a, b, c, d), 123456789);
+    }
 }
@@ -0,0 +1,912 @@
+import asyncio
+import io
+import json
+import math
+import os
+import pickle
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import *
+from unittest.mock import Mock
+
+import black
+import pytest
+import pytest_asyncio
+
+from blackfast import cache
+from blackfast import client
+from blackfast import config
+from blackfast import demon
+from blackfast import discovery
+from blackfast import git
+from blackfast import ipcserver
+from blackfast import metrics
+from blackfast import pool
+from blackfast import project
+from blackfast import protocol
+from blackfast import ranges
+from blackfast import registry
+from blackfast import server
+from blackfast import store
+from blackfast import worker
+from blackfast.protocol import Frame
+
+CLIENTS = 4
+FORMAT_DURATION = 0.5
+
+
+@pytest.fixture(scope="module")
+def patched():
+    server.monkeypatch()
+
+
+# pytest_asyncio.fixture only exists in newer versions, which need it
+async_fixture = getattr(pytest_asyncio, "fixture", pytest.fixture)
+
+
+@async_fixture
+async def socket_path(tmp_path: Path) -> AsyncIterator[str]:
+    """The path of a server socket answering requests."""
+    path = str(tmp_path / "blackfast.socket")
+    ipc = await asyncio.start_unix_server(server.connected, path)
+    try:
+        yield path
+    finally:
+        ipc.close()
+        await ipc.wait_closed()
+
+
+@pytest.fixture(autouse=True)
+def isolated_store(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(server, "STORE", store.Store(tmp_path / "verified.bfstore"))
+
+
+def slow_format_bytes(*args: Any) -> Optional[bytes]:
+    time.sleep(FORMAT_DURATION)
+    return None
+
+
+async def request(
+    socket_path: str, *args: str, frames: Optional[List[Tuple[Frame, bytes]]] = None
+) -> int:
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(protocol.hello())
+    writer.write(protocol.pack(Frame.ARGS, json.dumps(args).encode("utf-8")))
+    while True:
+        kind, _, payload = await protocol.read_frame(reader)
+        if frames is not None:
+            frames.append((kind, payload))
+        if kind is Frame.EXIT:
+            writer.close()
+            return protocol.I32.unpack(payload)[0]
+
+
+def test_format_cache_evicts_least_recently_used():
+    format_cache = cache.FormatCache(3 * cache.ENTRY_OVERHEAD + 10)
+    keys = [
+        cache.make_key(cache.digest(f"{i}\n".encode()), 88, black.FileMode.AUTO_DETECT)
+        for i in range(3)
+    ]
+    for key in keys:
+        format_cache.put(key, cache.Entry(None, verified=True))
+    assert format_cache.get(keys[0], fast=False) is not None
+    format_cache.put(keys[1], cache.Entry(b"x" * 11, verified=True))
+    assert format_cache.get(keys[0], fast=False) is not None
+    assert format_cache.get(keys[1], fast=False) is not None
+    assert format_cache.get(keys[2], fast=False) is None
+    assert format_cache.size <= format_cache.max_size
+
+
+def test_format_cache_fast_results_are_not_used_for_safe_runs(tmp_path):
+    format_cache = cache.FormatCache(1024 * 1024)
+    key = cache.make_key(cache.digest(b"x=1\n"), 88, black.FileMode.AUTO_DETECT)
+    format_cache.put(key, cache.Entry(b"x = 1\n", verified=False))
+    assert format_cache.get(key, fast=False) is None
+    assert format_cache.get(key, fast=True).formatted == b"x = 1\n"
+    path = tmp_path / "cache.pickle"
+    cache.dump(format_cache.snapshot(), path)
+    loaded = cache.FormatCache(1024 * 1024)
+    loaded.load(path)
+    assert loaded.get(key, fast=True).formatted == b"x = 1\n"
+
+
+def test_store_export_and_import(tmp_path: Path):
+    keys = [(cache.digest(str(i).encode()), 88, 0, "test") for i in range(2000)]
+    local = store.Store(tmp_path / "local.bfstore")
+    for key in keys[:1500]:
+        local.add(key)
+    assert len(local) == 1500
+    # the other process sees the keys of the first right away
+    assert keys[0] in store.Store(local.path)
+    assert local.export(tmp_path / "export.bfstore") == 1500
+    remote = store.Store(tmp_path / "remote.bfstore")
+    for key in keys[1000:]:
+        remote.add(key)
+    assert remote.load(tmp_path / "export.bfstore") == 1000
+    assert all(key in remote for key in keys)
+    assert (b"\0" * 32, 88, 0, "test") not in remote
+    (tmp_path / "broken.bfstore").write_bytes(b"not a store")
+    with pytest.raises(store.StoreError):
+        remote.load(tmp_path / "broken.bfstore")
+
+
+def test_pool_replaces_workers():
+    workers = pool.Pool(1, None, max_tasks=2, idle_timeout=0.1)
+    try:
+        pids = [workers.submit(os.getpid).result() for _ in range(4)]
+        assert pids[0] == pids[1] != pids[2] == pids[3]
+        assert workers.events == {"max_tasks": 2}
+        workers.max_memory = 1
+        first = workers.submit(os.getpid).result()
+        assert workers.submit(os.getpid).result() != first
+        assert workers.events["max_memory"] == 2
+        workers.max_memory = 0
+        workers.submit(os.getpid).result()
+        time.sleep(0.1)
+        workers.shrink_if_idle()
+        assert workers.executor is None
+        assert workers.events["idle"] == 1
+        assert workers.submit(sum, [1, 2]).result() == 3
+    finally:
+        workers.shutdown()
+
+
+def test_pool_starts_workers_in_the_background():
+    workers = pool.Pool(2, "spawn")
+    try:
+        ready = workers.start()
+        # spawned workers import black first
+        assert not any(future.done() for future in ready)
+        pid = workers.submit(os.getpid).result()
+        assert pid in workers.executor._processes
+    finally:
+        workers.shutdown()
+
+
+def test_pool_kills_tasks():
+    workers = pool.Pool(2, None)
+    try:
+        stuck = workers.submit(time.sleep, 60)
+        other = workers.submit(time.sleep, 0.5)
+        time.sleep(0.2)
+        workers.kill(stuck)
+        with pytest.raises(pool.TaskTimeout):
+            stuck.result()
+        # killed too, and run again
+        assert other.result() is None
+        assert workers.events == {"timeout": 1, "retried": 1}
+        assert workers.submit(sum, [1, 2]).result() == 3
+    finally:
+        workers.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_runs_biggest_tasks_first():
+    started = []
+    scheduler = pool.Scheduler(ThreadPoolExecutor(1), 1, timeout=0.5)
+    blocker = asyncio.ensure_future(scheduler.run(0, time.sleep, 0.1))
+    await asyncio.sleep(0)
+    tasks = [scheduler.run(size, started.append, size) for size in (1, 3, 2)]
+    await asyncio.gather(blocker, *tasks)
+    assert started == [3, 2, 1]
+    with pytest.raises(pool.TaskTimeout):
+        await scheduler.run(0, time.sleep, 1)
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_runs_interactive_tasks_first():
+    started = []
+    scheduler = pool.Scheduler(ThreadPoolExecutor(2), 2, reserved=1)
+    bulk = [
+        asyncio.ensure_future(scheduler.run(size, time.sleep, 0.1)) for size in (1, 2)
+    ]
+    await asyncio.sleep(0)
+    # the second bulk task waits, the reserved slot is free
+    assert scheduler.as_dict()["waiting"] == {"interactive": 0, "bulk": 1}
+    await scheduler.run(0, started.append, "editor", priority=pool.Priority.INTERACTIVE)
+    assert started == ["editor"]
+    await asyncio.gather(*bulk)
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_restarts_the_timeout_of_retried_tasks():
+    workers = pool.Pool(2, None)
+    scheduler = pool.Scheduler(workers, 2, timeout=2)
+    try:
+        stuck = asyncio.ensure_future(scheduler.run(0, time.sleep, 60))
+        await asyncio.sleep(1)
+        # killed along with the stuck task after a second, then run again
+        other = asyncio.ensure_future(scheduler.run(0, time.sleep, 1.2))
+        with pytest.raises(pool.TaskTimeout):
+            await stuck
+        assert await other is None
+        assert workers.events == {"timeout": 1, "retried": 1}
+    finally:
+        workers.shutdown()
+
+
+def test_batches_go_biggest_file_first(tmp_path: Path):
+    for name, size in [("small.py", 1), ("big.py", 100), ("medium.py", 10)]:
+        (tmp_path / name).write_text("x" * size)
+    batch = [tmp_path / name for name in ("small.py", "big.py", "medium.py")]
+    assert server.biggest_first(batch + [Path("-")]) == [
+        tmp_path / "big.py",
+        tmp_path / "medium.py",
+        tmp_path / "small.py",
+        Path("-"),
+    ]
+
+
+def test_histogram_quantiles():
+    histogram = metrics.Histogram()
+    assert histogram.quantile(0.5) == 0
+    for _ in range(90):
+        histogram.observe(0.003)
+    for _ in range(10):
+        histogram.observe(20)
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(0.95) == math.inf
+    data = histogram.as_dict()
+    assert data["p99"] == "+Inf"
+    assert data["buckets"]["0.0025"] == 0
+    assert data["buckets"]["0.005"] == 90
+    assert data["buckets"]["+Inf"] == 100
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_index_picks_up_changes(monkeypatch, tmp_path: Path, inotify: bool):
+    if not inotify:
+        monkeypatch.setattr(discovery, "Watcher", None)
+    elif discovery.Watcher is None:
+        pytest.skip("inotify is not available")
+    pkg = tmp_path / "pkg"
+    pkg.mkdir()
+    a = pkg / "a.py"
+    a.write_text("x = 1\n")
+    index = discovery.Index(
+        tmp_path,
+        re.compile(black.DEFAULT_INCLUDES),
+        black.re_compile_maybe_verbose(black.DEFAULT_EXCLUDES),
+    )
+    assert index.files(tmp_path, black.Report()) == [a]
+    index.record(a, discovery.get_stat(a), b"digest")
+    assert index.known_digests([a]) == {a: b"digest"}
+    b = pkg / "b.py"
+    b.write_text("y = 2\n")
+    a.write_text("x = 10\n")
+    # make sure the mtime changes even on file systems with coarse timestamps
+    mtime = pkg.stat().st_mtime_ns
+    os.utime(pkg, ns=(mtime, mtime + 1))
+    assert sorted(index.files(tmp_path, black.Report())) == [a, b]
+    assert index.known_digests([a]) == {}
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+def test_collect_changed_sources(tmp_path: Path):
+    def run_git(*args: str) -> None:
+        subprocess.run(["git", *args], cwd=str(tmp_path), check=True)
+
+    run_git("init", "-q")
+    for name in ["committed.py", "changed.py", "staged.py", "build/changed.py"]:
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_text("x = 1\n")
+    run_git("add", ".")
+    run_git("-c", "user.name=t", "-c", "user.email=t@t", "commit", "-qm", "initial")
+    for name in ["changed.py", "staged.py", "build/changed.py", "new.py", "new.txt"]:
+        (tmp_path / name).write_text("x = 2\n")
+    run_git("add", "staged.py")
+    index = discovery.Index(
+        tmp_path,
+        re.compile(black.DEFAULT_INCLUDES),
+        black.re_compile_maybe_verbose(black.DEFAULT_EXCLUDES),
+    )
+
+    def collect(*args: Any) -> List[str]:
+        sources = server.collect_sources((".",), tmp_path, index, black.Report(), *args)
+        return sorted(path.name for path in sources)
+
+    assert collect("HEAD") == ["changed.py", "new.py", "staged.py"]
+    assert collect(None, True) == ["staged.py"]
+    with pytest.raises(git.GitError):
+        collect("--output=x")
+
+
+@pytest.mark.asyncio
+async def test_sources_are_formatted_while_they_are_found(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(server, "BATCH_SIZE", 1)
+    monkeypatch.setattr(server, "MAX_IN_PROGRESS", 2)
+    found: List[Path] = []
+    # how many files were found when each started formatting
+    started: List[int] = []
+
+    def walk() -> Iterator[Path]:
+        for i in range(10):
+            found.append(tmp_path / f"{i}.py")
+            yield found[-1]
+
+    async def reformat(src: Path, *args: Any, **kwargs: Any) -> None:
+        started.append(len(found))
+        await asyncio.sleep(0.01)
+
+    monkeypatch.setattr(server, "reformat", reformat)
+    index = discovery.Index(tmp_path, re.compile(""), re.compile("^$"))
+    sources = walk()
+    await server.format_sources(
+        server.take(sources, 1),
+        sources,
+        index,
+        line_length=88,
+        fast=False,
+        write_back=black.WriteBack.NO,
+        mode=black.FileMode.AUTO_DETECT,
+        line_ranges=(),
+        stdin=None,
+        report=black.Report(),
+    )
+    assert len(started) == 10
+    # formatting started right away, and finding files waited for it
+    assert all(count <= i + 2 for i, count in enumerate(started))
+
+
+@pytest.mark.asyncio
+async def test_handshake_rejects_other_protocol_versions():
+    reader = asyncio.StreamReader()
+    reader.feed_data(
+        protocol.pack(Frame.HELLO, protocol.U32.pack(protocol.VERSION + 1))
+    )
+    writer = Mock()
+    with pytest.raises(protocol.ProtocolError):
+        await protocol.handshake(reader, writer)
+    writer.write.assert_called_once_with(protocol.hello())
+
+
+@pytest.mark.asyncio
+async def test_read_request():
+    reader = asyncio.StreamReader()
+    reader.feed_data(protocol.pack(Frame.STDIN, b"x=1\n"))
+    reader.feed_data(protocol.pack(Frame.ARGS, b'["--work-dir", "/", "-"]'))
+    assert await protocol.read_request(reader) == (
+        0,
+        ["--work-dir", "/", "-"],
+        b"x=1\n",
+    )
+    # frames of requests sent at the same time can be interleaved
+    pending: Dict[int, bytes] = {}
+    reader.feed_data(protocol.pack(Frame.STDIN, b"y=2\n", 2))
+    reader.feed_data(protocol.pack(Frame.STDIN, b"z=3\n", 1))
+    reader.feed_data(protocol.pack(Frame.ARGS, b'["-"]', 1))
+    reader.feed_data(protocol.pack(Frame.ARGS, b'["-"]', 2))
+    assert await protocol.read_request(reader, pending) == (1, ["-"], b"z=3\n")
+    assert await protocol.read_request(reader, pending) == (2, ["-"], b"y=2\n")
+    # malformed arguments are a protocol error rather than a crash
+    for payload in (b"[-", b'{"-": 1}', b"[1]"):
+        reader.feed_data(protocol.pack(Frame.ARGS, payload))
+        with pytest.raises(protocol.ProtocolError):
+            await protocol.read_request(reader)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_concurrent_clients_are_served_in_parallel(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    monkeypatch.setattr(
+        server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(CLIENTS), CLIENTS)
+    )
+    monkeypatch.setattr(server, "format_bytes", slow_format_bytes)
+    paths = [tmp_path / f"{i}.py" for i in range(CLIENTS)]
+    for i, path in enumerate(paths):
+        path.write_text(f"x = {i}\n")
+    start = time.monotonic()
+    return_codes = await asyncio.gather(
+        *(request(socket_path, "--work-dir", str(tmp_path), str(p)) for p in paths)
+    )
+    elapsed = time.monotonic() - start
+    assert return_codes == [0] * CLIENTS
+    # serving the clients one after the other would take CLIENTS times as long
+    assert elapsed < FORMAT_DURATION * 2
+
+
+@pytest.mark.asyncio
+async def test_watch_prechecks_changed_files(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(1), 1))
+    monkeypatch.setattr(server, "WATCH_DELAY", 0)
+    monkeypatch.setenv("BLACKFAST_WATCH_INTERVAL", "0.05")
+    src = tmp_path / "a.py"
+    src.write_text("x=1\n")
+    options = (88, False, black.FileMode.AUTO_DETECT)
+    server.add_watch(
+        tmp_path,
+        re.compile(black.DEFAULT_INCLUDES),
+        black.re_compile_maybe_verbose(black.DEFAULT_EXCLUDES),
+        [tmp_path],
+        options,
+    )
+    key = (tmp_path, black.DEFAULT_INCLUDES, black.DEFAULT_EXCLUDES)
+    try:
+        await asyncio.sleep(0.5)
+        src.write_text("y=2\n")
+        await asyncio.sleep(0.5)
+        entry = server.CACHE.get(
+            cache.make_key(cache.digest(b"y=2\n"), 88, black.FileMode.AUTO_DETECT),
+            fast=False,
+        )
+        assert entry.formatted == b"y = 2\n"
+    finally:
+        server.WATCHES.pop(key).task.cancel()
+        server.INDEXES.pop(key).close()
+
+
+def test_evicted_indexes_are_closed_once_released(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(server, "MAX_INDEXES", 1)
+    monkeypatch.setattr(server, "INDEXES", OrderedDict())
+    include = re.compile(black.DEFAULT_INCLUDES)
+    with server.lease_index(tmp_path, include, re.compile("a")) as leased:
+        close = leased.close = Mock(side_effect=leased.close)
+        server.get_index(tmp_path, include, re.compile("b")).close()
+        assert not close.called
+    close.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+async def test_watch_retries_failures_only_once_changed(monkeypatch, tmp_path: Path):
+    format_bytes = Mock(side_effect=server.format_bytes)
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(1), 1))
+    monkeypatch.setattr(server, "format_bytes", format_bytes)
+    src = tmp_path / "a.py"
+    src.write_text("x = (\n")
+    index = discovery.Index(
+        tmp_path, re.compile(black.DEFAULT_INCLUDES), re.compile("")
+    )
+    watch = server.Watch(index)
+    watch.task.cancel()
+    watch.add([tmp_path], (88, True, black.FileMode.AUTO_DETECT))
+    try:
+        await watch.refresh()
+        await watch.refresh()
+        assert format_bytes.call_count == 1
+        src.write_text("x = (1,\n")
+        await watch.refresh()
+        assert format_bytes.call_count == 2
+        assert len(watch.failed) == 1
+    finally:
+        index.close()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_concurrent_requests_for_the_same_source_are_coalesced(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    format_bytes = Mock(side_effect=slow_format_bytes)
+    monkeypatch.setattr(
+        server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(CLIENTS), CLIENTS)
+    )
+    monkeypatch.setattr(server, "format_bytes", format_bytes)
+    paths = [tmp_path / f"{i}.py" for i in range(CLIENTS)]
+    for path in paths:
+        path.write_text("coalesced = True\n")
+    return_codes = await asyncio.gather(
+        *(request(socket_path, "--work-dir", str(tmp_path), str(p)) for p in paths),
+        *(request(socket_path, "--work-dir", str(tmp_path), str(p)) for p in paths),
+    )
+    assert return_codes == [0] * CLIENTS * 2
+    assert format_bytes.call_count == 1
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_server_stops_once_black_changed(monkeypatch, socket_path: str):
+    kill = Mock()
+    monkeypatch.setattr(os, "kill", kill)
+    monkeypatch.setattr(server, "BLACK_STAMP", -1)
+    monkeypatch.setattr(server, "OUTDATED", False)
+    for _ in range(2):
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(protocol.hello())
+        assert await protocol.read_frame(reader) == (
+            Frame.HELLO,
+            0,
+            protocol.U32.pack(protocol.VERSION),
+        )
+        kind, _, payload = await protocol.read_frame(reader)
+        assert kind is Frame.ERROR
+        assert b"restarts now" in payload
+        writer.close()
+    kill.assert_called_once_with(os.getpid(), signal.SIGINT)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_errors_finding_the_project_are_answered(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    def get_project(args: List[str]) -> None:
+        raise PermissionError("denied")
+
+    monkeypatch.setattr(server, "get_project", get_project)
+    frames: List[Tuple[Frame, bytes]] = []
+    args = ["--work-dir", str(tmp_path), str(tmp_path)]
+    assert await request(socket_path, *args, frames=frames) == -1
+    assert (Frame.STDERR, b"INTERNAL ERROR: denied\n") in frames
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_abandoned_requests_are_cancelled(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    format_bytes = Mock(side_effect=slow_format_bytes)
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(1), 1))
+    monkeypatch.setattr(server, "format_bytes", format_bytes)
+    monkeypatch.setattr(server, "METRICS", metrics.Metrics(1))
+    for i in range(3):
+        (tmp_path / f"{i}.py").write_text(f"abandoned = {i}\n")
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(protocol.hello())
+    args = ["--work-dir", str(tmp_path), str(tmp_path)]
+    writer.write(protocol.pack(Frame.ARGS, json.dumps(args).encode("utf-8")))
+    await asyncio.sleep(FORMAT_DURATION / 2)
+    writer.close()
+    await asyncio.sleep(FORMAT_DURATION)
+    # only the file being formatted when the client left was
+    assert format_bytes.call_count == 1
+    assert server.METRICS.counters["cancelled_requests"] == 1
+    assert server.METRICS.counters["cancelled_formats"] == 3
+
+    async with await client.Connection.open(socket_path) as connection:
+        work_dir = str(tmp_path)
+        args = ["--supersede", "buffer", "-"]
+        earlier = asyncio.ensure_future(
+            connection.request(args, b"earlier = 1\n", work_dir)
+        )
+        await asyncio.sleep(FORMAT_DURATION / 2)
+        later = await connection.request(args, b"later = 1\n", work_dir)
+        assert later.exit_code == 0
+        assert (await earlier).exit_code == server.SUPERSEDED
+        assert b"Superseded" in (await earlier).stderr
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_blocking_requests_format_stdin(
+    patched, tmp_path: Path, socket_path: str
+):
+    loop = asyncio.get_event_loop()
+
+    def blocking_request(source: bytes) -> Tuple[int, bytes]:
+        stdout = io.BytesIO()
+        args = ["--work-dir", str(tmp_path), "-q", "-"]
+        code = protocol.request(socket_path, args, stdout, io.BytesIO(), source)
+        return code, stdout.getvalue()
+
+    for source, formatted in [(b"x=1\n", b"x = 1\n"), (b"y = 2\n", b"y = 2\n")]:
+        assert await loop.run_in_executor(None, blocking_request, source) == (
+            0,
+            formatted,
+        )
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_verification_modes(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    verify_bytes = Mock(side_effect=server.verify_bytes)
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(1), 1))
+    monkeypatch.setattr(server, "verify_bytes", verify_bytes)
+    monkeypatch.setattr(server, "CACHE", cache.FormatCache(1024 * 1024))
+    monkeypatch.setattr(server, "UNSAFE", set())
+    src = tmp_path / "a.py"
+    src.write_text("x=1\n")
+    args = ["--work-dir", str(tmp_path), "--check", "--verify", "cached", str(src)]
+    assert await request(socket_path, *args) == 1
+    assert verify_bytes.call_count == 1
+    # the store still knows the result was checked once the cache forgot it
+    monkeypatch.setattr(server, "CACHE", cache.FormatCache(1024 * 1024))
+    assert await request(socket_path, *args) == 1
+    assert verify_bytes.call_count == 1
+
+    checking = threading.Event()
+
+    def fail(*args: Any) -> None:
+        checking.wait(5)
+        raise AssertionError("not equivalent")
+
+    verify_bytes.side_effect = fail
+    src.write_text("y=2\n")
+    args = ["--work-dir", str(tmp_path), "--verify", "deferred", str(src)]
+    assert await request(socket_path, *args) == 0
+    assert src.read_text() == "y = 2\n"
+    checking.set()
+    await asyncio.gather(*server.BACKGROUND)
+    assert src.read_text() == "y=2\n"
+    # checked before writing from now on
+    assert await request(socket_path, *args) == 123
+    assert src.read_text() == "y=2\n"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_results_are_streamed(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(2), 2))
+    (tmp_path / "good.py").write_text("streamed = 1\n")
+    (tmp_path / "bad.py").write_text("streamed=2\n")
+    (tmp_path / "broken.py").write_text("streamed = (\n")
+    frames: List[Tuple[Frame, bytes]] = []
+    return_code = await request(
+        socket_path,
+        "--work-dir",
+        str(tmp_path),
+        "--stream",
+        "--diff",
+        ".",
+        frames=frames,
+    )
+    assert return_code == 123
+    results = {
+        Path(result["src"]).name: result
+        for result in (json.loads(p) for kind, p in frames if kind is Frame.RESULT)
+    }
+    assert results["good.py"]["status"] == "unchanged"
+    assert results["bad.py"]["status"] == "changed"
+    assert "+streamed = 2" in results["bad.py"]["diff"]
+    assert results["broken.py"]["status"] == "failed"
+    summary = [json.loads(p) for kind, p in frames if kind is Frame.SUMMARY]
+    assert summary == [{"changed": 1, "unchanged": 1, "failed": 1, "exit_code": 123}]
+    # the diffs are only part of the results
+    kinds = [kind for kind, _ in frames]
+    assert Frame.STDOUT not in kinds
+    assert kinds.index(Frame.SUMMARY) > max(
+        i for i, kind in enumerate(kinds) if kind is Frame.RESULT
+    )
+
+
+def test_workers_send_back_compact_results():
+    source = b"".join(b"x%d=[%d]\n" % (i, i) for i in range(1000))
+    options = (88, True, black.FileMode.AUTO_DETECT)
+    formatted = worker.format_bytes(source, *options)
+    result = worker.format_compact(source, *options, False)
+    assert result.digest == cache.digest(formatted)
+    assert len(pickle.dumps(result)) < len(pickle.dumps(formatted)) / 50
+    # nor do diffs, only their hunks
+    result = worker.format_compact(b"y=1\n" + formatted, *options, True)
+    assert len(pickle.dumps(result)) < len(pickle.dumps(formatted)) / 10
+    assert result.diff.startswith("@@ -1,6 +1,6 @@\n-y=1\n+y = 1\n")
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_check_and_diff_only_get_compact_results(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    format_bytes = Mock(side_effect=server.format_bytes)
+    format_compact = Mock(side_effect=server.format_compact)
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(1), 1))
+    monkeypatch.setattr(server, "CACHE", cache.FormatCache(1024 * 1024))
+    monkeypatch.setattr(server, "format_bytes", format_bytes)
+    monkeypatch.setattr(server, "format_compact", format_compact)
+    (tmp_path / "a.py").write_text("diffed=1\n")
+    for _ in range(2):
+        frames: List[Tuple[Frame, bytes]] = []
+        args = ("--work-dir", str(tmp_path), "--diff", "a.py")
+        assert await request(socket_path, *args, frames=frames) == 0
+        diff = b"".join(p for k, p in frames if k is Frame.STDOUT)
+        assert diff.startswith(f"--- {tmp_path / 'a.py'}\t".encode("utf-8"))
+        assert b"\n-diffed=1\n+diffed = 1\n" in diff
+    # the second diff came from the cache
+    assert format_compact.call_count == 1
+    (tmp_path / "b.py").write_text("checked=1\n")
+    args = ("--work-dir", str(tmp_path), "--check", "b.py")
+    assert await request(socket_path, *args) == 1
+    assert format_compact.call_count == 2
+    assert not format_bytes.called
+    # writing the file needs the formatted contents after all
+    assert await request(socket_path, "--work-dir", str(tmp_path), "b.py") == 0
+    assert format_bytes.call_count == 1
+    assert (tmp_path / "b.py").read_text() == "checked = 1\n"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_requests_on_one_connection_complete_out_of_order(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    def format_bytes(src: bytes, *args: Any) -> Optional[bytes]:
+        if src.startswith(b"slow"):
+            time.sleep(FORMAT_DURATION)
+        return src.replace(b"=", b" = ")
+
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(2), 2))
+    monkeypatch.setattr(server, "format_bytes", format_bytes)
+    async with client.Pool(socket_path, size=1) as clients:
+        slow = asyncio.ensure_future(clients.request(["-"], b"slow=1\n", str(tmp_path)))
+        fast = asyncio.ensure_future(clients.request(["-"], b"fast=1\n", str(tmp_path)))
+        done, _ = await asyncio.wait([slow, fast], return_when=asyncio.FIRST_COMPLETED)
+        assert done == {fast}
+        assert fast.result().formatted == b"fast = 1\n"
+        assert (await slow).formatted == b"slow = 1\n"
+        assert len(clients.connections) == 1
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_cancelled_requests_leave_the_connection_usable(
+    patched, monkeypatch, tmp_path: Path, socket_path: str
+):
+    def format_bytes(src: bytes, *args: Any) -> Optional[bytes]:
+        time.sleep(FORMAT_DURATION)
+        return src.replace(b"=", b" = ")
+
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(2), 2))
+    monkeypatch.setattr(server, "format_bytes", format_bytes)
+    async with await client.Connection.open(socket_path) as connection:
+        work_dir = str(tmp_path)
+        kept = asyncio.ensure_future(connection.request(["-"], b"kept=1\n", work_dir))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                connection.request(["-"], b"given_up=1\n", work_dir),
+                FORMAT_DURATION / 2,
+            )
+        assert (await kept).formatted == b"kept = 1\n"
+        # the late answer to the cancelled request did not break the connection
+        await asyncio.sleep(FORMAT_DURATION / 2)
+        assert not connection.closed
+        later = await connection.request(["-"], b"later=1\n", work_dir)
+        assert later.formatted == b"later = 1\n"
+
+
+def test_statements_overlapping_line_ranges():
+    source = (
+        "import os\n"
+        "# comment\n"
+        "@decorator\n"
+        "def f( a ):\n"
+        "    return a\n"
+        "if x:\n"
+        "    y=1\n"
+        "else:\n"
+        "    y=2\n"
+        "broken = (\n"
+    )
+    assert ranges.statements(source, [(2, 2)]) == []
+    assert ranges.statements(source, [(1, 1), (4, 4)]) == [(0, 1), (2, 5)]
+    assert ranges.statements(source, [(8, 8)]) == [(5, 9)]
+
+
+@pytest.mark.asyncio
+async def test_line_ranges_only_format_changed_statements(monkeypatch):
+    format_bytes = Mock(side_effect=server.format_bytes)
+    monkeypatch.setattr(server, "SCHEDULER", pool.Scheduler(ThreadPoolExecutor(1), 1))
+    monkeypatch.setattr(server, "format_bytes", format_bytes)
+    options = dict(line_length=88, fast=True, mode=black.FileMode.AUTO_DETECT)
+
+    async def format_lines(source: bytes, *line_ranges: ranges.LineRange) -> bytes:
+        digest = cache.digest(source)
+        entry, _ = await server.format_selected(source, digest, line_ranges, **options)
+        return source if entry.formatted is None else entry.formatted
+
+    source = b"a=1\nb=[\n  2]\nc=3\n"
+    assert await format_lines(source, (2, 2)) == b"a=1\nb = [2]\nc=3\n"
+    assert format_bytes.call_count == 1
+    assert await format_lines(source, (1, 4)) == b"a = 1\nb = [2]\nc = 3\n"
+    assert format_bytes.call_count == 3
+    # only the edited statement is formatted again
+    edited = b"a=1\nb=[\n  2]\nc=4\n"
+    assert await format_lines(edited, (1, 4)) == b"a = 1\nb = [2]\nc = 4\n"
+    assert format_bytes.call_count == 4
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+@pytest.mark.asyncio
+async def test_clients_can_connect_while_the_server_starts(tmp_path: Path):
+    socket_path = str(tmp_path / "blackfast.socket")
+    ready = asyncio.Event()
+    started = asyncio.Event()
+
+    async def callback(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(b"started" if started.is_set() else b"starting")
+        writer.close()
+
+    async def prepare():
+        await asyncio.sleep(0.1)
+        started.set()
+
+    task = asyncio.ensure_future(
+        ipcserver.run(socket_path, "", callback, prepare, ready.set)
+    )
+    await ready.wait()
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    assert await reader.read() == b"started"
+    writer.close()
+    task.cancel()
+
+
+def test_projects_reload_changed_configuration(tmp_path: Path):
+    work_dir = tmp_path / "src"
+    work_dir.mkdir()
+    (tmp_path / ".git").mkdir()
+    projects = project.Projects(4)
+    first = projects.get(work_dir)
+    assert first.root == tmp_path.resolve()
+    assert first.config_file is None
+    assert projects.get(work_dir) is first
+    (tmp_path / "pyproject.toml").write_text("[tool.black]\nline-length = 20\n")
+    second = projects.get(work_dir)
+    assert second.defaults == {"line_length": 20}
+    # a pyproject.toml closer to the work dir makes it the project root
+    (work_dir / "pyproject.toml").write_text(
+        "[tool.black]\nskip-string-normalization = true\n"
+    )
+    third = projects.get(work_dir)
+    assert third.root == work_dir.resolve()
+    assert third.defaults == {"skip_string_normalization": True}
+    assert third.compile("x") is third.compile("x")
+
+
+def test_registry_evicts_least_recently_used_servers(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(registry, "SERVERS_DIR", str(tmp_path))
+    # seconds since last use
+    ages = {"old": 20, "current": 30, "recent": 10, "older": 25}
+    for server_id, age in ages.items():
+        registry.register(server_id, {"pid_file": str(tmp_path / f"{server_id}.pid")})
+        mtime = time.time() - age
+        os.utime(registry.info_file(server_id), (mtime, mtime))
+    registry.evict("current", 2)
+    assert [server[0] for server in registry.servers()] == ["recent", "old", "current"]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses unix sockets")
+def test_registry_only_stops_servers_which_answer(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(registry, "SERVERS_DIR", str(tmp_path))
+    kill = Mock()
+    monkeypatch.setattr(demon, "kill", kill)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(str(tmp_path / "live.socket"))
+        sock.listen(1)
+        for server_id in ("live", "stale"):
+            info = {
+                "pid_file": str(tmp_path / f"{server_id}.pid"),
+                "address": str(tmp_path / f"{server_id}.socket"),
+            }
+            registry.register(server_id, info)
+        registry.evict("current", 0)
+    kill.assert_called_once_with(tmp_path / "live.pid")
+    assert registry.servers() == []
+
+
+def test_server_id_matches_the_rust_client(monkeypatch, tmp_path: Path):
+    # see test_fnv1a in src/main.rs
+    assert config.fnv1a(b"") == 0xCBF29CE484222325
+    assert config.fnv1a(b"/usr/bin") == 0x0C0CA4C92F66AB32
+    monkeypatch.delenv("BLACKFAST_SERVER_ID", raising=False)
+    monkeypatch.setattr(sys, "argv", [str(tmp_path / "blackfast-server")])
+    # the directory of the canonical path of the script, as the client hashes it
+    expected = config.fnv1a(str(tmp_path.resolve()).encode("utf-8"))
+    assert config.get_server_id() == f"{expected:016x}"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses symlinks")
+def test_server_id_tells_virtualenvs_apart(monkeypatch, tmp_path: Path):
+    monkeypatch.delenv("BLACKFAST_SERVER_ID", raising=False)
+    monkeypatch.setattr(sys, "argv", ["-m"])
+    scripts = tmp_path / "venv" / "bin"
+    scripts.mkdir(parents=True)
+    (scripts / "python").symlink_to(sys.executable)
+    monkeypatch.setattr(sys, "executable", str(scripts / "python"))
+    expected = config.fnv1a(str(scripts.resolve()).encode("utf-8"))
+    assert config.get_server_id() == f"{expected:016x}"
@@ -1,28 +1,67 @@
+import json
 import os
 import statistics
+import sys
+import tempfile
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
 from subprocess import call, DEVNULL
-from typing import Callable, List, Tuple, Iterable, Union
-import black
+from typing import Callable, Dict, List, Tuple, Iterable, Iterator, Optional, Union
 import click
 import tabulate
 
+from blackfast.config import get_pid_file
+
 BLACKFAST = os.path.join(
     os.path.dirname(__file__), "..", "target", "release", "blackfast"
 )
-
-
-def _black() -> float:
+MULTI_FILE_COUNT = 50
+# seconds to wait for the server to exit once it was stopped
+STOP_TIMEOUT = 10
+# files per directory of generated corpora
+FILES_PER_DIR = 100
+# needs formatting, and is long enough for formatting to matter
+TEMPLATE = """\
+'''Generated module {i} ({marker}).'''
+import os, sys
+from typing import *
+CONSTANT_{i}={i}
+def function_{i}(argument_one,argument_two = None, *args, **kwargs):
+    '''Do something.'''
+    if argument_two is None: argument_two = {{'key': [1,2,3], "other": (4,5,6)}}
+    result = [value * CONSTANT_{i} for value in range(argument_one) if value % 2 == 0 and value % 3 == 0 or value % 5 == 0]
+    return os.path.join( str(argument_one), str(argument_two), *[str(arg) for arg in args] )
+class Class_{i}( object ):
+    attribute = function_{i}( 10 )
+    def method(self, x, y) :
+        return self.attribute,x,y
+    @property
+    def other_method(self): return {{ "a":1, 'b':2, 'c': [ 1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20 ] }}
+"""
+
+
+def _black(path: str) -> float:
     start = time.monotonic()
-    call(["black", __file__], stderr=DEVNULL, stdout=DEVNULL, stdin=DEVNULL)
+    call(["black", path], stderr=DEVNULL, stdout=DEVNULL, stdin=DEVNULL)
     end = time.monotonic()
     return end - start
 
 
-def _uncache():
-    cache = black.get_cache_file(black.DEFAULT_LINE_LENGTH, black.FileMode.AUTO_DETECT)
-    if cache.exists():
-        cache.unlink()
+@contextmanager
+def _source() -> Iterator[str]:
+    """A copy of this file with unique contents, so neither black's cache nor
+    the server's format cache and store know it, until it was formatted once."""
+    with open(__file__) as fobj:
+        source = fobj.read()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.py")
+        with open(path, "w") as fobj:
+            fobj.write(f"{source}\n# {uuid.uuid4().hex}\n")
+        yield path
 
 
 def _start():
@@ -31,78 +70,263 @@ def _start():
 
 def _stop():
     call(["blackfast-server", "stop"], stderr=DEVNULL, stdout=DEVNULL, stdin=DEVNULL)
+    # the server exits some time after it was told to, a cold run must not
+    # reach it meanwhile
+    pid_file = get_pid_file()
+    deadline = time.monotonic() + STOP_TIMEOUT
+    while pid_file.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
 
 
-def _blackfast():
+def _blackfast(path: str) -> float:
     start = time.monotonic()
-    call([BLACKFAST, __file__], stderr=DEVNULL, stdout=DEVNULL, stdin=DEVNULL)
+    call([BLACKFAST, path], stderr=DEVNULL, stdout=DEVNULL, stdin=DEVNULL)
     end = time.monotonic()
     return end - start
 
 
 def black_cached() -> float:
-    _black()
-    return _black()
+    with _source() as path:
+        _black(path)
+        return _black(path)
 
 
 def black_uncached() -> float:
-    _uncache()
-    return _black()
+    with _source() as path:
+        return _black(path)
 
 
 def blackfast_cached_cold() -> float:
-    _stop()
-    _black()
-    return _blackfast()
+    with _source() as path:
+        _start()
+        _blackfast(path)
+        _stop()
+        return _blackfast(path)
 
 
 def blackfast_uncached_cold() -> float:
-    _stop()
-    _uncache()
-    return _blackfast()
+    with _source() as path:
+        _stop()
+        return _blackfast(path)
 
 
 def blackfast_cached_hot() -> float:
-    _start()
-    _blackfast()
-    return _blackfast()
+    with _source() as path:
+        _start()
+        _blackfast(path)
+        return _blackfast(path)
 
 
 def blackfast_uncached_hot() -> float:
+    with _source() as path:
+        _start()
+        return _blackfast(path)
+
+
+def blackfast_first_multi_file() -> float:
+    _stop()
     _start()
-    _uncache()
-    return _blackfast()
+    with open(__file__) as fobj:
+        source = fobj.read()
+    with tempfile.TemporaryDirectory() as directory:
+        # unique contents, so nothing can be answered from the format cache
+        marker = uuid.uuid4().hex
+        for i in range(MULTI_FILE_COUNT):
+            with open(os.path.join(directory, f"bench_{i}.py"), "w") as fobj:
+                fobj.write(f"{source}\n# {marker} {i}\n")
+        start = time.monotonic()
+        call(
+            [BLACKFAST, "--check", directory],
+            stderr=DEVNULL,
+            stdout=DEVNULL,
+            stdin=DEVNULL,
+        )
+        end = time.monotonic()
+    return end - start
 
 
-Benchmark = Callable[[], float]
-BENCHMARKS: List[Benchmark] = [
-    black_cached,
-    black_uncached,
-    blackfast_cached_cold,
-    blackfast_uncached_cold,
-    blackfast_cached_hot,
-    blackfast_uncached_hot,
-]
+def _corpus(directory: Path, files: int) -> None:
+    # unique contents, so nothing can be answered from a cache of earlier runs
+    marker = uuid.uuid4().hex
+    for i in range(files):
+        package = directory / f"package_{i // FILES_PER_DIR}"
+        package.mkdir(exist_ok=True)
+        (package / f"module_{i}.py").write_text(TEMPLATE.format(i=i, marker=marker))
+
 
+def _run_clients(command: List[str], directories: List[Path]) -> float:
+    def run(directory: Path) -> None:
+        call([*command, str(directory)], stderr=DEVNULL, stdout=DEVNULL, stdin=DEVNULL)
 
-def run(iterations: int) -> Iterable[Tuple[str, List[float]]]:
+    start = time.monotonic()
+    with ThreadPoolExecutor(len(directories)) as executor:
+        list(executor.map(run, directories))
+    return time.monotonic() - start
+
+
+def tree(tool: str, state: str, mode: str, files: int, clients: int) -> float:
+    """Time `clients` concurrent runs of `tool` over `files` files each.
+
+    `state` is "cold" (server stopped), "warm" (server running, files not seen
+    before) or "hot" (server running, files seen before).
+    """
+    command = [BLACKFAST if tool == "blackfast" else "black", f"--{mode}"]
+    with tempfile.TemporaryDirectory() as tmp:
+        directories = [Path(tmp) / f"client_{client}" for client in range(clients)]
+        for directory in directories:
+            directory.mkdir()
+            _corpus(directory, files)
+        if tool == "blackfast":
+            if state == "cold":
+                _stop()
+            else:
+                _start()
+        if state == "hot":
+            _run_clients(command, directories)
+        return _run_clients(command, directories)
+
+
+Benchmark = Tuple[str, int, Callable[[], float]]
+BENCHMARKS: List[Benchmark] = [
+    (bench.__name__, 1, bench)
+    for bench in [
+        black_cached,
+        black_uncached,
+        blackfast_cached_cold,
+        blackfast_uncached_cold,
+        blackfast_cached_hot,
+        blackfast_uncached_hot,
+    ]
+] + [("blackfast_first_multi_file", MULTI_FILE_COUNT, blackfast_first_multi_file)]
+
+
+def tree_benchmarks(sizes: Iterable[int], clients: int) -> Iterable[Benchmark]:
+    for files in sizes:
+        for mode in ["check", "diff"]:
+            for tool, state in [
+                ("black", "hot"),
+                ("blackfast", "cold"),
+                ("blackfast", "warm"),
+                ("blackfast", "hot"),
+            ]:
+                name = f"{tool}_{files}_files_{mode}_{state}"
+                yield name, files, partial(tree, tool, state, mode, files, 1)
+        if clients > 1:
+            for state in ["warm", "hot"]:
+                name = f"blackfast_{files}_files_check_{state}_{clients}_clients"
+                runner = partial(tree, "blackfast", state, "check", files, clients)
+                yield name, files * clients, runner
+
+
+def run(
+    benchmarks: Iterable[Benchmark], iterations: int
+) -> Iterable[Tuple[str, int, List[float]]]:
     return (
-        (bench.__name__, [bench() for _ in range(iterations)]) for bench in BENCHMARKS
+        (name, files, [bench() for _ in range(iterations)])
+        for name, files, bench in benchmarks
     )
 
 
-def analyze(runs: List[float]) -> Iterable[float]:
-    yield statistics.mean(runs)
-    yield statistics.median(runs)
-    yield statistics.stdev(runs)
+def percentile(runs: List[float], q: float) -> float:
+    ordered = sorted(runs)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def analyze(files: int, runs: List[float]) -> Dict[str, float]:
+    p50 = percentile(runs, 0.5)
+    return {
+        "files": files,
+        "mean": statistics.mean(runs),
+        "stdev": statistics.stdev(runs) if len(runs) > 1 else 0.0,
+        "p50": p50,
+        "p95": percentile(runs, 0.95),
+        "p99": percentile(runs, 0.99),
+        "files_per_second": files / p50 if p50 else 0.0,
+    }
+
+
+def regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> Iterable[str]:
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        limit = baseline[name]["p50"] * (1 + tolerance)
+        if result["p50"] > limit:
+            yield (
+                f"{name}: p50 {result['p50']:.5f}s is slower than the baseline "
+                f"{baseline[name]['p50']:.5f}s"
+            )
 
 
 @click.command()
-@click.option("-i", "--iterations", type=click.IntRange(0), default=25)
-def main(iterations: int) -> None:
-    headers = ["name", "mean", "median", "stdev"]
-    data = [(name, *analyze(runs)) for name, runs in run(iterations)]
-    print(tabulate.tabulate(data, headers, floatfmt=".5f"))
+@click.option("-i", "--iterations", type=click.IntRange(1), default=25)
+@click.option(
+    "-s",
+    "--size",
+    "sizes",
+    type=click.IntRange(1),
+    multiple=True,
+    default=[1, 100, 10000],
+    help="Number of files in the generated trees, can be given more than once.",
+)
+@click.option(
+    "-c",
+    "--clients",
+    type=click.IntRange(1),
+    default=4,
+    help="Number of concurrent clients in the concurrency benchmarks.",
+)
+@click.option(
+    "-k", "--filter", "name_filter", help="Only run benchmarks containing this."
+)
+@click.option("-j", "--json-output", type=click.Path(dir_okay=False))
+@click.option(
+    "-b",
+    "--baseline",
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON output of an earlier run to compare against.",
+)
+@click.option(
+    "-t",
+    "--tolerance",
+    type=float,
+    default=0.1,
+    help="How much slower than the baseline a benchmark may be.",
+)
+def main(
+    iterations: int,
+    sizes: Tuple[int, ...],
+    clients: int,
+    name_filter: Optional[str],
+    json_output: Optional[str],
+    baseline: Optional[str],
+    tolerance: float,
+) -> None:
+    benchmarks = [*BENCHMARKS, *tree_benchmarks(sizes, clients)]
+    if name_filter:
+        benchmarks = [bench for bench in benchmarks if name_filter in bench[0]]
+    results = {
+        name: analyze(files, runs) for name, files, runs in run(benchmarks, iterations)
+    }
+    columns = ["files", "mean", "p50", "p95", "p99", "stdev", "files_per_second"]
+    data = [
+        (name, *(result[column] for column in columns))
+        for name, result in results.items()
+    ]
+    print(tabulate.tabulate(data, ["name", *columns], floatfmt=".5f"))
+    if json_output:
+        with open(json_output, "w") as fobj:
+            json.dump({"iterations": iterations, "benchmarks": results}, fobj, indent=2)
+    if baseline:
+        with open(baseline) as fobj:
+            found = list(regressions(results, json.load(fobj)["benchmarks"], tolerance))
+        for message in found:
+            print(message, file=sys.stderr)
+        if found:
+            sys.exit(1)
 
 
 if __name__ == "__main__":